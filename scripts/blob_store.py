@@ -0,0 +1,70 @@
+import os
+import re
+import shutil
+import hashlib
+from urllib.parse import urlsplit
+
+# Constants and Configuration
+BLOB_ROOT = "cache/blobs"
+HASH_NAME = re.compile(r'[0-9a-f]{64}')  # Coomer/Kemono name files by their SHA-256
+
+def server_hash(url):
+    """SHA-256 the server put in the file name, or None"""
+    stem = os.path.splitext(os.path.basename(urlsplit(url).path))[0].lower()
+    return stem if HASH_NAME.fullmatch(stem) else None
+
+def file_sha256(fname):
+    with open(fname, "rb") as f:
+        return hashlib.file_digest(f, "sha256").hexdigest()
+
+def link_file(src, dst):
+    """Make dst the same file as src, as a hardlink where the filesystem allows it"""
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    try:
+        os.link(src, dst)
+    except FileExistsError:
+        pass
+    except OSError:
+        shutil.copyfile(src, dst)  # No hardlinks on this filesystem
+
+class BlobStore:
+    """Content-addressed copies of downloaded files, keyed by SHA-256.
+
+    Every finished download is hardlinked into <root>/<aa>/<sha256><ext>, and
+    a later file with the same content (a repost under another post or
+    creator) becomes another hardlink to that blob instead of a second copy
+    on disk. When the server hash is in the URL the lookup happens before
+    any request is made.
+    """
+
+    def __init__(self, root=BLOB_ROOT):
+        self.root = root
+
+    def path(self, digest, ext):
+        return os.path.join(self.root, digest[:2], f"{digest}{ext}")
+
+    def link(self, digest, out_fname):
+        """Create out_fname from an existing blob; returns False if there is none"""
+        blob = self.path(digest, os.path.splitext(out_fname)[1])
+        if not os.path.exists(blob):
+            return False
+        link_file(blob, out_fname)
+        return True
+
+    def adopt(self, out_fname, digest=None):
+        """Add a finished download to the store, or swap it for a link to an identical blob"""
+        digest = digest or file_sha256(out_fname)
+        blob = self.path(digest, os.path.splitext(out_fname)[1])
+        os.makedirs(os.path.dirname(blob), exist_ok=True)
+        try:
+            os.link(out_fname, blob)
+            return digest
+        except FileExistsError:
+            pass
+        except OSError:
+            return digest
+        if not os.path.samefile(blob, out_fname):
+            tmp_fname = f"{out_fname}.link"
+            os.link(blob, tmp_fname)
+            os.replace(tmp_fname, out_fname)
+        return digest
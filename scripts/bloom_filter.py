@@ -0,0 +1,59 @@
+import os
+import struct
+
+# Constants and Configuration
+MAGIC = b'BLM1'
+HEADER = struct.Struct('<4sxxxxqqqq')  # magic, bits, hashes, then a caller tag of two ints
+BITS_PER_KEY = 10  # ~1% false positives with HASHES probes
+HASHES = 7
+
+class BloomFilter:
+    """Bloom filter over 64-bit integer keys (such as id_store keys).
+
+    The probe positions come from splitting the already uniform key into
+    two 32-bit halves (double hashing), so no extra hashing is needed.
+    """
+
+    def __init__(self, nbits, hashes=HASHES, bits=None):
+        self.nbits = max(nbits, 8)
+        self.hashes = hashes
+        self.bits = bits if bits is not None else bytearray((self.nbits + 7) // 8)
+
+    @classmethod
+    def for_keys(cls, count):
+        """Create an empty filter sized for `count` keys"""
+        return cls(count * BITS_PER_KEY)
+
+    def positions(self, key):
+        h1 = key & 0xFFFFFFFF
+        h2 = ((key >> 32) & 0xFFFFFFFF) | 1
+        return ((h1 + i * h2) % self.nbits for i in range(self.hashes))
+
+    def add(self, key):
+        for pos in self.positions(key):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, key):
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self.positions(key))
+
+    def save(self, fname, tag=(0, 0)):
+        """Write the filter atomically; `tag` records what it was built from"""
+        tmp_fname = f"{fname}.tmp"
+        with open(tmp_fname, "wb") as f:
+            f.write(HEADER.pack(MAGIC, self.nbits, self.hashes, *tag))
+            f.write(self.bits)
+        os.replace(tmp_fname, fname)
+
+    @classmethod
+    def load(cls, fname):
+        """Return (filter, tag), or (None, None) if the file is missing or damaged"""
+        try:
+            with open(fname, "rb") as f:
+                data = f.read()
+            magic, nbits, hashes, *tag = HEADER.unpack_from(data)
+        except (FileNotFoundError, struct.error):
+            return None, None
+        bits = bytearray(data[HEADER.size:])
+        if magic != MAGIC or len(bits) != (nbits + 7) // 8:
+            return None, None
+        return cls(nbits, hashes, bits), tuple(tag)
@@ -0,0 +1,128 @@
+import asyncio
+from collections import deque
+
+# Constants and Configuration
+MIN_TRANSFERS = 2  # Never go below this many transfers per host
+WINDOW_SECONDS = 5  # Length of one measurement window
+ERROR_RATE_LIMIT = 0.1  # Failed attempts above this share count as overload
+DECREASE_FACTOR = 0.7  # Multiplicative decrease on overload
+LATENCY_TOLERANCE = 2.0  # Response latency this far above the best seen means queueing
+BASE_LATENCY_DRIFT = 1.05  # Lets the latency baseline creep up when a mirror gets slower
+MIN_GAIN = 0.05  # Throughput must move this much to count as a change
+
+def debug_log(msg, show_debug=True):
+    if show_debug:
+        print(msg)
+
+class ConcurrencyController:
+    """Adaptive limit on concurrent transfers to one host.
+
+    Used as an async context manager around each transfer, like a
+    semaphore whose size changes. Every WINDOW_SECONDS it looks at the
+    window's error rate, response latency and throughput:
+
+    * too many failed attempts -> multiplicative decrease (AIMD),
+    * latency well above the best seen so far -> step down by one,
+    * all slots busy and throughput still rising -> step up by one,
+    * throughput fell right after a step up -> take that step back.
+    """
+
+    def __init__(self, name, start, min_limit=MIN_TRANSFERS, max_limit=None, show_debug=True):
+        self.name = name
+        self.min_limit = min(min_limit, start)
+        self.max_limit = max_limit or start
+        self.limit = max(self.min_limit, min(start, self.max_limit))
+        self.show_debug = show_debug
+        self.active = 0
+        self.waiters = deque()
+
+        self.base_latency = None
+        self.last_throughput = 0
+        self.last_change = 0
+        self.reset_window()
+
+    def reset_window(self):
+        self.window_start = asyncio.get_running_loop().time()
+        self.window_bytes = 0
+        self.window_results = 0
+        self.window_errors = 0
+        self.window_latencies = []
+        self.window_peak = self.active
+
+    async def __aenter__(self):
+        while self.active >= self.limit:
+            waiter = asyncio.get_running_loop().create_future()
+            self.waiters.append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                if waiter in self.waiters:
+                    self.waiters.remove(waiter)
+                elif waiter.done() and not waiter.cancelled():
+                    self.wake()  # Pass the slot we were handed on to someone else
+                raise
+        self.active += 1
+        self.window_peak = max(self.window_peak, self.active)
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.active -= 1
+        self.wake()
+
+    def wake(self):
+        free = self.limit - self.active
+        while free > 0 and self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                free -= 1
+
+    def add_bytes(self, count):
+        self.window_bytes += count
+        self.maybe_adjust()
+
+    def record_latency(self, seconds):
+        self.window_latencies.append(seconds)
+
+    def record_result(self, ok):
+        self.window_results += 1
+        if not ok:
+            self.window_errors += 1
+        self.maybe_adjust()
+
+    def maybe_adjust(self):
+        elapsed = asyncio.get_running_loop().time() - self.window_start
+        if elapsed < WINDOW_SECONDS:
+            return
+
+        throughput = self.window_bytes / elapsed
+        error_rate = self.window_errors / self.window_results if self.window_results else 0
+        latency = sum(self.window_latencies) / len(self.window_latencies) if self.window_latencies else None
+        if latency is not None:
+            if self.base_latency is None:
+                self.base_latency = latency
+            else:
+                self.base_latency = min(latency, self.base_latency * BASE_LATENCY_DRIFT)
+
+        new_limit = self.limit
+        if error_rate > ERROR_RATE_LIMIT:
+            new_limit = int(self.limit * DECREASE_FACTOR)
+            reason = f"{error_rate:.0%} failed attempts"
+        elif latency is not None and latency > self.base_latency * LATENCY_TOLERANCE:
+            new_limit = self.limit - 1
+            reason = f"latency {latency:.2f}s vs {self.base_latency:.2f}s baseline"
+        elif self.last_change > 0 and throughput < self.last_throughput * (1 - MIN_GAIN):
+            new_limit = self.limit - 1
+            reason = "throughput fell after the last increase"
+        elif self.window_peak >= self.limit and throughput >= self.last_throughput * (1 - MIN_GAIN):
+            new_limit = self.limit + 1
+            reason = "all slots busy"
+
+        new_limit = max(self.min_limit, min(self.max_limit, new_limit))
+        self.last_change = new_limit - self.limit
+        if self.last_change:
+            debug_log(f"  🔧 {self.name}: {self.limit} -> {new_limit} transfers ({reason})", self.show_debug)
+            self.limit = new_limit
+            self.wake()
+        self.last_throughput = throughput
+        self.reset_window()
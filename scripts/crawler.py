@@ -0,0 +1,246 @@
+import os
+import json
+import time
+import asyncio
+from contextlib import aclosing
+from functools import partial
+
+# Constants and Configuration
+CRAWL_CONCURRENCY = 4  # Creators paged at the same time
+BACKFILL_HOURS = 24  # Ignore the high-water marks once this often, 0 disables
+
+def debug_log(msg, show_debug=True):
+    if show_debug:
+        print(msg)
+
+def anonymize_name(name):
+    """Convert creator names to anonymous format (first 2 chars + ****)"""
+    return f"{name[:2]}****" if len(name) > 2 else name
+
+def post_number(item):
+    """Numeric post ID used for high-water marks, or None if the ID is not a number"""
+    try:
+        return int(item.get('id'))
+    except (TypeError, ValueError):
+        return None
+
+def below_mark(items, mark):
+    """True if every post on a listing page is at or below the high-water mark"""
+    if mark is None:
+        return False
+    numbers = [post_number(item) for item in items]
+    return all(n is not None and n <= mark for n in numbers)
+
+def newest_post(items, newest=None):
+    """Highest numeric post ID among items and the newest seen so far"""
+    numbers = [n for n in map(post_number, items) if n is not None]
+    if newest is not None:
+        numbers.append(newest)
+    return max(numbers, default=None)
+
+async def crawl_in_order(crawls, concurrency=CRAWL_CONCURRENCY):
+    """Run several crawls at once while handing their results back in crawl order.
+
+    crawls is a list of zero-argument callables that each return an async
+    generator (one per creator). Up to `concurrency` of them are paged at the
+    same time. This yields (index, items) per crawl, in list order: the
+    first one streams live, later ones replay whatever their crawl has
+    buffered in the meantime. The consumer therefore sees exactly the
+    sequence a one-at-a-time loop would produce, which keeps --max-urls
+    and the per-creator summaries deterministic.
+
+    Breaking out early cancels every crawl that is still running.
+    """
+    done = object()
+    slots = asyncio.Semaphore(concurrency)
+    buffers = [asyncio.Queue() for _ in crawls]
+
+    async def run(crawl, buffer):
+        try:
+            async with slots:
+                async with aclosing(crawl()) as items:
+                    async for item in items:
+                        buffer.put_nowait(item)
+        finally:
+            buffer.put_nowait(done)
+
+    async def replay(buffer, task):
+        while (item := await buffer.get()) is not done:
+            yield item
+        await task  # Surface errors raised inside the crawl
+
+    tasks = [asyncio.ensure_future(run(crawl, buffer)) for crawl, buffer in zip(crawls, buffers)]
+    try:
+        for index, (buffer, task) in enumerate(zip(buffers, tasks)):
+            yield index, replay(buffer, task)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+def display_creator_summary(creator, summary, show_debug=True):
+    debug_log(f"📊 Creator {creator} summary:", show_debug)
+    debug_log(f"  • Pages checked: {summary.get('pages', 0)}", show_debug)
+    debug_log(f"  • Posts checked: {summary.get('posts', 0)}", show_debug)
+    debug_log(f"  • New posts found: {summary.get('new', 0)}", show_debug)
+
+async def queue_creator_posts(queue, crawls, cached_ids, marks, creator_stats, args):
+    """Feed download tasks for every creator into queue, stopping at --max-urls.
+
+    crawls lists (label, creator, mark key, collect) per creator, where
+    collect is the site's collect_creator_posts with everything but mark
+    and summary already bound. Creators are paged concurrently but consumed
+    in list order, so the tasks queued are the same as a one-creator-at-a-time
+    crawl.
+    """
+    jobs = []
+    for label, creator, key, collect in crawls:
+        summary = {}
+        jobs.append((label, creator, key, summary, partial(collect, mark=marks.get(key), summary=summary)))
+
+    queued = set()
+    stopped = None
+    async with aclosing(crawl_in_order([job[-1] for job in jobs], args.crawl_concurrency)) as creator_crawls:
+        async for index, creator_posts in creator_crawls:
+            label, creator, key, summary, _ = jobs[index]
+            debug_log(f"🟢 Processing {label}: {anonymize_name(creator)}", args.debug)
+            async for download_url, out_fname, file_id in creator_posts:
+                if len(queued) >= args.max_urls:
+                    break
+                if (download_url, out_fname) in queued:
+                    continue
+                queued.add((download_url, out_fname))
+                stats = creator_stats.setdefault(creator_of(out_fname), new_creator_stats())
+                stats['total'] += 1
+                stats['posts'].add(file_id)
+                await queue.put((download_url, out_fname, file_id))
+
+            if len(queued) >= args.max_urls:
+                debug_log(f"🟢 Reached maximum URL limit of {args.max_urls}", args.debug)
+                stopped = (creator, summary)
+                break
+            display_creator_summary(creator, summary, args.debug)
+            if summary.get('mark') is not None:
+                marks.propose(key, creator, summary['mark'])
+
+    if stopped:
+        # The crawl that hit the limit is cancelled on the way out, so its summary is final now
+        display_creator_summary(*stopped, args.debug)
+
+    debug_log(f"🟢 Queued {len(queued)} unique files for download.", args.debug)
+    display_download_preview(creator_stats, cached_ids, args.debug)
+
+def creator_of(out_fname):
+    return os.path.basename(os.path.dirname(out_fname))  # Path already simplified
+
+def new_creator_stats():
+    return {'total': 0, 'posts': set(), 'success': 0, 'success_posts': set()}
+
+def display_download_preview(creator_stats, cached_ids, show_debug=True):
+    """Display preview of the downloads queued so far."""
+    if not show_debug:
+        return
+
+    print("\n📊 Download Preview:")
+    print("=" * 50)
+
+    print("\n👤 Per Creator Breakdown:")
+    print("-" * 50)
+    for creator, stats in creator_stats.items():
+        files = stats['total']
+        posts = len(stats['posts'])
+        ratio = files / posts if posts > 0 else 0
+        print(f"  • {anonymize_name(creator)}:")
+        print(f"    - Files to download: {files}")
+        print(f"    - Unique posts: {posts}")
+        print(f"    - Files per post: {ratio:.1f}")
+    
+    print("\n📈 Preview Totals:")
+    print("-" * 50)
+    total_files = sum(stats['total'] for stats in creator_stats.values())
+    total_posts = sum(len(stats['posts']) for stats in creator_stats.values())
+    print(f"  • Total files to download: {total_files}")
+    print(f"  • Total unique posts: {total_posts}")
+    print(f"  • Current cache size: {len(cached_ids)}")
+    print("=" * 50 + "\n")
+
+def display_download_results(creator_stats, cached_ids, successful_downloads, successful_ids, show_debug=True):
+    """Display final download results."""
+    if not show_debug:
+        return
+
+    print("\n📊 Download Results:")
+    print("=" * 50)
+
+    print("\n👤 Per Creator Results:")
+    print("-" * 50)
+    for creator, stats in creator_stats.items():
+        success_rate = (stats['success'] / stats['total'] * 100) if stats['total'] > 0 else 0
+        print(f"  • {anonymize_name(creator)}:")
+        print(f"    - Successfully downloaded: {stats['success']}/{stats['total']} files ({success_rate:.1f}%)")
+        print(f"    - Unique posts added: {len(stats['success_posts'])}")
+        if stats['success_posts']:
+            ratio = stats['success'] / len(stats['success_posts'])
+            print(f"    - Files per post: {ratio:.1f}")
+
+    print("\n📈 Final Totals:")
+    print("-" * 50)
+    print(f"  • Total files downloaded: {successful_downloads}")
+    print(f"  • New posts added to cache: {len(successful_ids)}")
+    print(f"  • Total cache size: {len(cached_ids)}")
+    print("=" * 50 + "\n")
+
+class CrawlMarks:
+    """Per-creator high-water marks (newest post ID seen) for incremental crawls.
+
+    A mark means every post at or below it has already been queued, so a
+    crawl can stop at the first listing page that is entirely below it.
+    Crawls propose a new mark only when they walked all the way down to the
+    old one (or to the end of the listing), and save() only advances it for
+    creators whose new files all downloaded, so nothing is skipped for good
+    after --max-urls, a failed page or a failed download. Every
+    backfill_hours the marks are ignored for one run to catch edited or
+    late-indexed posts.
+    """
+
+    def __init__(self, fname, backfill_hours=BACKFILL_HOURS, full=False, show_debug=True):
+        self.fname = fname
+        self.show_debug = show_debug
+        self.proposed = []
+        try:
+            with open(fname, "r") as f:
+                data = json.load(f)
+        except (FileNotFoundError, ValueError):
+            data = {}
+        self.marks = data.get('marks', {})
+        self.backfilled_at = data.get('backfilled_at', 0)
+
+        backfill_due = backfill_hours > 0 and time.time() - self.backfilled_at >= backfill_hours * 3600
+        self.full = full or backfill_due
+        if self.full and self.marks:
+            debug_log("🔵 Full crawl: ignoring high-water marks for this run.", show_debug)
+        elif self.marks:
+            debug_log(f"🟢 Loaded high-water marks for {len(self.marks)} creators.", show_debug)
+
+    def get(self, key):
+        return None if self.full else self.marks.get(key)
+
+    def propose(self, key, creator, mark):
+        """Record that a crawl reached its old mark, with the newest post it saw"""
+        self.proposed.append((key, creator, mark))
+
+    def save(self, creator_stats):
+        """Advance the marks of creators whose new files all downloaded, then write the file"""
+        for key, creator, mark in self.proposed:
+            stats = creator_stats.get(creator)
+            if stats and stats['success'] < stats['total']:
+                debug_log(f"🟠 Keeping the old mark for {key}: {stats['total'] - stats['success']} files failed", self.show_debug)
+                continue
+            self.marks[key] = max(mark, self.marks.get(key, mark))
+        if self.full:
+            self.backfilled_at = time.time()
+
+        tmp_fname = f"{self.fname}.tmp"
+        with open(tmp_fname, "w") as f:
+            json.dump({'marks': self.marks, 'backfilled_at': self.backfilled_at}, f)
+        os.replace(tmp_fname, self.fname)
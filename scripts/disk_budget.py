@@ -0,0 +1,77 @@
+import shutil
+import asyncio
+
+# Constants and Configuration
+MIN_FREE_SPACE = 2 * 1024 * 1024 * 1024  # 2GB always left free on the disk
+
+def debug_log(msg, show_debug=True):
+    if show_debug:
+        print(msg)
+
+def format_size(bytes):
+    """Convert bytes to human readable format"""
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if bytes < 1024:
+            return f"{bytes:.2f}{unit}"
+        bytes /= 1024
+    return f"{bytes:.2f}TB"
+
+class DiskFull(Exception):
+    """A download can't fit in the disk budget even with nothing else in flight"""
+
+class DiskBudget:
+    """Disk space handed out to downloads before they write anything.
+
+    Each download reserves the bytes it still needs (from Content-Length)
+    before its body is read, and releases them once it finishes or fails.
+    Reservations that don't fit wait for running downloads to finish; one
+    that doesn't fit with nothing else running is refused with DiskFull, so
+    no download can fill the disk halfway through a write. Only that task is
+    refused; the budget is marked exhausted once the disk itself has no room
+    left above min_free. Free space is measured whenever nothing is
+    reserved, and in between the budget counts what finished downloads kept.
+    """
+
+    def __init__(self, path="cache", min_free=MIN_FREE_SPACE, show_debug=True):
+        self.path = path
+        self.min_free = min_free
+        self.show_debug = show_debug
+        self.reservations = {}
+        self.changed = asyncio.Condition()
+        self.exhausted = False
+        self.sync()
+
+    def sync(self):
+        self.free = shutil.disk_usage(self.path).free
+        self.written = 0  # Bytes kept by downloads since free was measured
+
+    def available(self):
+        return self.free - self.min_free - self.written - sum(self.reservations.values())
+
+    async def reserve(self, key, size):
+        """Wait until size bytes fit in the budget and hold them for key, replacing any earlier reservation"""
+        async with self.changed:
+            self.reservations.pop(key, None)
+            waited = False
+            while True:
+                if not self.reservations:
+                    self.sync()
+                if size <= self.available():
+                    break
+                if not self.reservations:
+                    # Just measured, so this is the whole budget: bigger files are refused, smaller ones still fit
+                    self.exhausted = self.available() <= 0
+                    raise DiskFull(f"needs {format_size(size)}, only {format_size(max(self.available(), 0))} can be used")
+                if not waited:
+                    debug_log(f"  🟠 Waiting for {format_size(size)} of disk space ({len(self.reservations)} downloads in flight)", self.show_debug)
+                    waited = True
+                await self.changed.wait()
+            self.reservations[key] = size
+
+    async def release(self, key, kept=0):
+        """Free key's reservation, counting the kept bytes that are now on disk"""
+        async with self.changed:
+            if self.reservations.pop(key, None) is None:
+                return  # Never reached the network, nothing new on disk
+            self.written += kept
+            self.changed.notify_all()
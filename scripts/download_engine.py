@@ -0,0 +1,571 @@
+import os
+import re
+import json
+import asyncio
+import time
+from contextlib import asynccontextmanager
+from datetime import datetime
+from urllib.parse import urlsplit
+import aiohttp
+import psutil
+from concurrency import ConcurrencyController
+from rate_limiter import RateLimiter
+from blob_store import server_hash, link_file
+from disk_budget import DiskFull
+
+# Constants and Configuration
+TIMEOUT_SECONDS = 300  # 5 minutes
+CHUNK_SIZE = 1024 * 1024  # 1MB chunks, so peak memory stays around transfers x CHUNK_SIZE
+READ_BUFFER_SIZE = 256 * 1024  # Socket read buffer per response
+SPEED_INTERVAL = 1  # seconds between live speed updates
+MAX_CONNECTIONS = 100  # Size of the shared connection pool
+MAX_PER_HOST = 32  # Ceiling for concurrent transfers per host
+START_PER_HOST = 8  # Where each host's adaptive limit starts
+RETRY_TOTAL = 3
+RETRY_BACKOFF = 1  # seconds, doubled on every attempt
+RETRY_STATUSES = {429, 502, 503, 504}
+PART_SUFFIX = ".part"  # Partial downloads live next to the target until complete
+SEGMENT_THRESHOLD = 64 * 1024 * 1024  # Files at least this big are fetched in segments
+SEGMENT_SIZE = 16 * 1024 * 1024  # Size of each byte range
+SEGMENT_STREAMS = 4  # Concurrent ranges per file
+QUEUE_SIZE = 200  # Discovered tasks waiting for a download slot
+API_RATE = 2.0  # API page requests per second, per host
+FILE_RATE = 50.0  # File requests started per second, per host
+FILE_BURST = 16
+
+def debug_log(msg, show_debug=True):
+    if show_debug:
+        print(msg)
+
+def format_size(bytes):
+    """Convert bytes to human readable format"""
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if bytes < 1024:
+            return f"{bytes:.2f}{unit}"
+        bytes /= 1024
+    return f"{bytes:.2f}TB"
+
+def load_part_meta(part_fname, meta_fname):
+    """Return the validators saved for a .part file, or None if it can't be resumed"""
+    if not os.path.exists(part_fname):
+        return None
+    try:
+        with open(meta_fname, "r") as f:
+            meta = json.load(f)
+        if os.path.getsize(part_fname) <= meta['length']:
+            return meta
+    except (OSError, ValueError, KeyError):
+        pass
+    return None
+
+def save_part_meta(meta_fname, meta):
+    with open(meta_fname, "w") as f:
+        json.dump(meta, f)
+
+def finish_part(part_fname, meta_fname, out_fname):
+    """Atomically move a complete .part file into place and drop its metadata"""
+    os.replace(part_fname, out_fname)
+    if os.path.exists(meta_fname):
+        os.remove(meta_fname)
+
+def discard_part(part_fname, meta_fname):
+    for fname in (part_fname, meta_fname):
+        if os.path.exists(fname):
+            os.remove(fname)
+
+def missing_segments(meta):
+    """Indexes of the segments a segmented .part still lacks"""
+    done = set(meta['done'])
+    return [i for i in range(-(-meta['length'] // meta['segment_size'])) if i not in done]
+
+def content_range_total(response):
+    """Return the full length from a 206 response's Content-Range header"""
+    match = re.match(r"bytes \d+-\d+/(\d+)", response.headers.get('Content-Range', ''))
+    return int(match.group(1)) if match else None
+
+def get_system_info(engine):
+    """Get formatted system information panel"""
+    # Disk info
+    disk = psutil.disk_usage('cache')
+    disk_total_gb = disk.total / (1024**3)
+    disk_free_gb = disk.free / (1024**3)
+    disk_used_gb = disk.used / (1024**3)
+    disk_percent = disk.percent
+
+    # Memory info
+    mem = psutil.virtual_memory()
+    mem_total_gb = mem.total / (1024**3)
+    mem_free_gb = mem.available / (1024**3)
+    mem_used_gb = mem_total_gb - mem_free_gb
+    mem_percent = mem.percent
+
+    # Add total downloaded size
+    total_downloaded = format_size(engine.total_downloaded_bytes)
+
+    # Get current speed
+    speed = format_size(engine.current_speed) + "/s"
+
+    # Active downloads
+    current_tasks = list(engine.active_downloads.items())
+
+    panel = [
+        "\n💻 System Status Panel 💻",
+        "=" * 50,
+        f"📊 Storage Status (cache directory):",
+        f"  • Total: {disk_total_gb:.1f}GB",
+        f"  • Used:  {disk_used_gb:.1f}GB ({disk_percent}%)",
+        f"  • Free:  {disk_free_gb:.1f}GB ({100-disk_percent}%)",
+        f"  • Downloaded: {total_downloaded}",
+        f"  • Speed: {speed}",
+        f"  • Transfers: {engine.concurrency_summary()}",
+        "",
+        f"🧠 Memory Usage:",
+        f"  • Total: {mem_total_gb:.1f}GB",
+        f"  • Used:  {mem_used_gb:.1f}GB ({mem_percent}%)",
+        f"  • Free:  {mem_free_gb:.1f}GB ({100-mem_percent}%)",
+        "",
+        "🔄 Active Downloads:",
+    ]
+    
+    if not current_tasks:
+        panel.append("  • No active downloads.")
+    for task_name, (file_id, started_at) in current_tasks:
+        elapsed = (datetime.now() - started_at).seconds
+        panel.append(f"  • {task_name}: {file_id} (running {elapsed}s)")
+    
+    panel.extend(["", "=" * 50])
+    return "\n".join(panel)
+
+class DownloadEngine:
+    """Asyncio download engine shared by the Coomer, Kemono and Rule34 downloaders.
+
+    All transfers run as tasks on one event loop over a single pooled
+    aiohttp session, so hundreds of downloads can be in flight without
+    an OS thread each. Use it as an async context manager and feed it
+    through pipeline(), which starts downloading while the task list is
+    still being paged in:
+
+        async with DownloadEngine(show_debug=True) as engine:
+            async for url, fname, fid, success in engine.pipeline(produce):
+                ...
+    """
+
+    def __init__(self, max_connections=MAX_CONNECTIONS, max_per_host=MAX_PER_HOST,
+                 start_per_host=START_PER_HOST, timeout=TIMEOUT_SECONDS, segment_threshold=None, segment_size=SEGMENT_SIZE,
+                 segment_streams=SEGMENT_STREAMS, api_rate=API_RATE, file_rate=FILE_RATE, blobs=None, index=None, disk=None, show_debug=True):
+        self.max_connections = max_connections
+        self.max_per_host = max_per_host
+        self.start_per_host = start_per_host
+        self.timeout = timeout
+        self.segment_threshold = segment_threshold  # None keeps one stream per file
+        self.segment_size = segment_size
+        self.segment_streams = segment_streams
+        self.api_limiter = RateLimiter(api_rate, show_debug=show_debug)
+        self.file_limiter = RateLimiter(file_rate, burst=FILE_BURST, show_debug=show_debug)
+        self.blobs = blobs  # Optional BlobStore for content-addressed dedup
+        self.index = index  # Optional MediaIndex shared by all scripts
+        self.disk = disk  # Optional DiskBudget that downloads reserve space from
+        self.show_debug = show_debug
+        self.session = None
+        self.controllers = {}
+        self.pending = set()
+        self.inflight = {}  # Server hash -> Event set when that file's download finishes
+
+        # Download accounting, read by the system status panels
+        self.active_downloads = {}
+        self.total_downloaded_bytes = 0
+        self.current_speed = 0  # bytes per second
+        self.last_bytes_check = 0
+        self.last_check_time = time.time()
+
+    async def __aenter__(self):
+        connector = aiohttp.TCPConnector(limit=self.max_connections, limit_per_host=self.max_per_host)
+        timeout = aiohttp.ClientTimeout(total=None, sock_connect=self.timeout, sock_read=self.timeout)
+        self.session = aiohttp.ClientSession(connector=connector, timeout=timeout, read_bufsize=READ_BUFFER_SIZE)
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        # Cancel whatever is still queued, e.g. after a low disk space stop
+        for task in self.pending:
+            task.cancel()
+        if self.pending:
+            await asyncio.gather(*self.pending, return_exceptions=True)
+        await self.session.close()
+
+    def host_limit(self, url):
+        """Return the adaptive controller bounding concurrent transfers to the url's host"""
+        host = urlsplit(url).netloc
+        if host not in self.controllers:
+            self.controllers[host] = ConcurrencyController(
+                host, self.start_per_host, max_limit=self.max_per_host, show_debug=self.show_debug
+            )
+        return self.controllers[host]
+
+    def concurrency_summary(self):
+        """Active/allowed transfers per host, for the status panels"""
+        return ", ".join(
+            f"{host} {controller.active}/{controller.limit}" for host, controller in self.controllers.items()
+        ) or "idle"
+
+    def count_bytes(self, count, controller):
+        """Account for a received chunk as it arrives, keeping the speed readout live"""
+        self.total_downloaded_bytes += count
+        controller.add_bytes(count)
+        if time.time() - self.last_check_time >= SPEED_INTERVAL:
+            self.calculate_speed()
+
+    def calculate_speed(self):
+        """Calculate current download speed"""
+        now = time.time()
+        time_diff = now - self.last_check_time
+        if time_diff > 0:
+            bytes_diff = self.total_downloaded_bytes - self.last_bytes_check
+            self.current_speed = bytes_diff / time_diff
+            self.last_bytes_check = self.total_downloaded_bytes
+            self.last_check_time = now
+        return self.current_speed
+
+    async def reserve_space(self, download_url, out_fname):
+        """Reserve the bytes a download still needs before it takes a connection for the body.
+
+        A resumable .part already knows its length; a fresh download asks with
+        a HEAD request. Waiting for room happens here, outside the host's
+        controller, so a waiter holds no slot the running downloads need.
+        """
+        part_fname = out_fname + PART_SUFFIX
+        meta = load_part_meta(part_fname, part_fname + ".json")
+        if meta and 'done' in meta:
+            size = min(len(missing_segments(meta)) * meta['segment_size'], meta['length'])
+        elif meta:
+            size = meta['length'] - os.path.getsize(part_fname)
+        else:
+            size = None
+            try:
+                async with self.request(self.file_limiter, download_url, method="HEAD", allow_redirects=True) as r:
+                    if r.status < 400:
+                        size = r.content_length
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                pass  # The GET reports the real error
+        await self.disk.reserve(out_fname, size or 0)  # Unknown sizes are counted once the file is kept
+
+    @asynccontextmanager
+    async def request(self, limiter, url, controller=None, method="GET", **kwargs):
+        """session.request() gated by a per-host token bucket that adapts to 429/503 replies"""
+        await limiter.acquire(url)
+        started = time.monotonic()
+        async with self.session.request(method, url, **kwargs) as r:
+            limiter.record(url, r.status, r.headers)
+            if controller:
+                controller.record_latency(time.monotonic() - started)
+            yield r
+
+    async def retry(self, func, *args):
+        """Await func(*args), retrying connection errors and 429/502/503/504 responses with backoff"""
+        for attempt in range(RETRY_TOTAL + 1):
+            try:
+                return await func(*args)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                retryable = not isinstance(e, aiohttp.ClientResponseError) or e.status in RETRY_STATUSES
+                if not retryable or attempt == RETRY_TOTAL:
+                    raise
+                await asyncio.sleep(RETRY_BACKOFF * (2 ** attempt))
+
+    async def fetch_json(self, url, params=None, cache=None):
+        """GET an API page through the pooled session, with the same retries as downloads.
+
+        With an HttpCache the request is conditional, and a 304 returns the
+        stored body without reading the response.
+        """
+        key = cache.key(url, params) if cache else None
+        async def get():
+            headers = cache.headers(key) if cache else None
+            async with self.request(self.api_limiter, url, params=params, headers=headers) as r:
+                if r.status == 304 and cache:
+                    return cache.hit(key)
+                r.raise_for_status()
+                body = await r.json(content_type=None)
+                if cache:
+                    cache.store(key, r.headers, body)
+                return body
+        return await self.retry(get)
+
+    async def attempt(self, download_url, out_fname, controller):
+        """One try at a download, reported to the host's concurrency controller"""
+        try:
+            bytes_downloaded = await self.stream_to_file(download_url, out_fname, controller)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            # Dead links say nothing about load, only timeouts and overload replies do
+            if not isinstance(e, aiohttp.ClientResponseError) or e.status in RETRY_STATUSES:
+                controller.record_result(False)
+            raise
+        controller.record_result(True)
+        return bytes_downloaded
+
+    async def stream_to_file(self, download_url, out_fname, controller):
+        """Stream the response body to out_fname in CHUNK_SIZE pieces.
+
+        Data lands in a .part sidecar next to out_fname and is resumed with a
+        Range request on the next attempt, as long as the server still reports
+        the same ETag/Last-Modified and total length. The finished file is
+        renamed into place, so out_fname only ever exists complete.
+        """
+        if os.path.exists(out_fname):
+            return 0
+
+        part_fname = out_fname + PART_SUFFIX
+        meta_fname = part_fname + ".json"
+        meta = load_part_meta(part_fname, meta_fname)
+        if meta and 'done' in meta:
+            return await self.fetch_segments(download_url, part_fname, meta_fname, out_fname, meta, controller)
+
+        offset = os.path.getsize(part_fname) if meta else 0
+        if meta and offset == meta['length']:
+            # The previous attempt already had every byte
+            finish_part(part_fname, meta_fname, out_fname)
+            return 0
+
+        headers = {'Accept-Encoding': 'identity'}
+        if offset:
+            headers['Range'] = f"bytes={offset}-"
+            headers['If-Range'] = meta['validator']
+
+        async with self.request(self.file_limiter, download_url, controller, headers=headers) as r:
+            if r.status == 416:
+                # Our .part no longer lines up with the server copy, start over
+                discard_part(part_fname, meta_fname)
+                raise aiohttp.ClientPayloadError(f"Range not satisfiable for {download_url}")
+            r.raise_for_status()
+
+            if r.status == 206:
+                if content_range_total(r) != meta['length']:
+                    discard_part(part_fname, meta_fname)
+                    raise aiohttp.ClientPayloadError(f"Remote size changed for {download_url}")
+                mode = "ab"
+                expected_length = meta['length']
+            else:
+                # Fresh download, or the file changed since the .part was written
+                mode = "wb"
+                offset = 0
+                expected_length = r.content_length
+                validator = r.headers.get('ETag') or r.headers.get('Last-Modified')
+                if validator and expected_length:
+                    meta = {'url': download_url, 'validator': validator, 'length': expected_length}
+                    if self.should_segment(r, expected_length):
+                        # Leave this response unread; the ranges are fetched in parallel below
+                        meta.update({'segment_size': self.segment_size, 'done': []})
+                    save_part_meta(meta_fname, meta)
+                elif os.path.exists(meta_fname):
+                    os.remove(meta_fname)  # Nothing to validate a resume against
+
+            if 'done' not in (meta or {}):
+                bytes_downloaded = 0
+                with open(part_fname, mode) as f:
+                    async for chunk in r.content.iter_chunked(CHUNK_SIZE):
+                        bytes_downloaded += len(chunk)
+                        f.write(chunk)
+                        self.count_bytes(len(chunk), controller)
+
+        if meta and 'done' in meta:
+            return await self.fetch_segments(download_url, part_fname, meta_fname, out_fname, meta, controller)
+
+        if expected_length is not None and offset + bytes_downloaded != expected_length:
+            raise aiohttp.ClientPayloadError(
+                f"Incomplete download: got {offset + bytes_downloaded} of {expected_length} bytes"
+            )
+        finish_part(part_fname, meta_fname, out_fname)
+        return bytes_downloaded
+
+    def should_segment(self, response, length):
+        """Whether a fresh response is big enough, and rangeable, to fetch in segments"""
+        return (
+            self.segment_threshold is not None
+            and length >= self.segment_threshold
+            and response.headers.get('Accept-Ranges', '').lower() == 'bytes'
+        )
+
+    async def fetch_segments(self, download_url, part_fname, meta_fname, out_fname, meta, controller):
+        """Fetch a large file as concurrent byte ranges written straight to their offsets.
+
+        The .part file is preallocated to the full length and every range is
+        written with os.pwrite, so segments can land in any order. Finished
+        segment indexes are recorded in the .part.json sidecar, which lets a
+        retry within the run fetch only the missing ones.
+        """
+        length = meta['length']
+        segment_size = meta['segment_size']
+        done = set(meta['done'])
+        missing = missing_segments(meta)
+
+        if not os.path.exists(part_fname):
+            with open(part_fname, "wb") as f:
+                f.truncate(length)
+
+        debug_log(f"  🔵 Fetching {len(missing)} segments of {os.path.basename(out_fname)} in parallel", self.show_debug)
+        streams = asyncio.Semaphore(self.segment_streams)
+        fd = os.open(part_fname, os.O_WRONLY)
+        try:
+            async def fetch(index):
+                start = index * segment_size
+                end = min(start + segment_size, length) - 1
+                headers = {
+                    'Accept-Encoding': 'identity',
+                    'Range': f"bytes={start}-{end}",
+                    'If-Range': meta['validator'],
+                }
+                async with streams:
+                    async with self.request(self.file_limiter, download_url, controller, headers=headers) as r:
+                        r.raise_for_status()
+                        if r.status != 206 or content_range_total(r) != length:
+                            # The server copy changed under us, the whole file has to restart
+                            discard_part(part_fname, meta_fname)
+                            raise aiohttp.ClientPayloadError(f"Remote file changed for {download_url}")
+                        position = start
+                        async for chunk in r.content.iter_chunked(CHUNK_SIZE):
+                            os.pwrite(fd, chunk, position)
+                            position += len(chunk)
+                            self.count_bytes(len(chunk), controller)
+                if position != end + 1:
+                    raise aiohttp.ClientPayloadError(f"Incomplete segment {index} for {download_url}")
+                done.add(index)
+                meta['done'] = sorted(done)
+                save_part_meta(meta_fname, meta)
+                return end + 1 - start
+
+            tasks = [asyncio.ensure_future(fetch(i)) for i in missing]
+            finished, unfinished = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+            for task in unfinished:
+                task.cancel()
+            await asyncio.gather(*unfinished, return_exceptions=True)
+        finally:
+            os.close(fd)
+
+        for task in tasks:
+            if task.done() and not task.cancelled() and task.exception():
+                raise task.exception()
+        finish_part(part_fname, meta_fname, out_fname)
+        return sum(task.result() for task in tasks)
+
+    def record_file(self, download_url, out_fname, file_id):
+        """Hash a finished download into the blob store and media index, sharing storage with an earlier copy"""
+        digest = server_hash(download_url)
+        if self.blobs:
+            digest = self.blobs.adopt(out_fname, digest)
+        if self.index:
+            duplicate = self.index.add(out_fname, digest, download_url)
+            if duplicate and os.path.exists(duplicate):
+                if not os.path.samefile(duplicate, out_fname):
+                    tmp_fname = f"{out_fname}.link"
+                    link_file(duplicate, tmp_fname)
+                    os.replace(tmp_fname, out_fname)
+                debug_log(f"  🔵 {file_id}: same content as {duplicate}, sharing that copy", self.show_debug)
+            elif duplicate:
+                # The earlier copy was mirrored by another runner, don't upload it twice
+                os.remove(out_fname)
+                debug_log(f"  🔵 {file_id}: same content as {duplicate}, not keeping a second copy", self.show_debug)
+
+    async def download_file(self, download_url, out_fname, file_id):
+        """Download file using streaming to minimize memory usage"""
+        task_name = asyncio.current_task().get_name()
+        inflight = None
+        try:
+            digest = server_hash(download_url) if self.blobs else None
+            if digest and not os.path.exists(out_fname):
+                if digest in self.inflight:
+                    debug_log(f"  🔵 {file_id}: {digest[:12]} is already downloading, waiting for it", self.show_debug)
+                while digest in self.inflight:
+                    await self.inflight[digest].wait()
+                if self.blobs.link(digest, out_fname):
+                    debug_log(f"  🔵 {file_id}: reusing stored copy of {digest[:12]}", self.show_debug)
+                    return True
+                # Reposts of this file queued after us wait for the blob instead of fetching it again
+                inflight = self.inflight[digest] = asyncio.Event()
+
+            mirrored = self.index.find_url(download_url) if self.index else None
+            if mirrored and mirrored != out_fname:
+                if os.path.exists(mirrored):
+                    link_file(mirrored, out_fname)
+                    debug_log(f"  🔵 {file_id}: reusing existing file {mirrored}", self.show_debug)
+                else:
+                    debug_log(f"  🔵 {file_id}: already mirrored as {mirrored} by an earlier run, skipping", self.show_debug)
+                return True
+
+            os.makedirs(os.path.dirname(out_fname), exist_ok=True)
+            if self.disk and not os.path.exists(out_fname):
+                await self.reserve_space(download_url, out_fname)
+            controller = self.host_limit(download_url)
+            async with controller:
+                # Registered once the host lets it start, so queued tasks do not show as active
+                self.active_downloads[task_name] = (file_id, datetime.now())
+                await self.retry(self.attempt, download_url, out_fname, controller)
+            if self.blobs or self.index:
+                await asyncio.to_thread(self.record_file, download_url, out_fname, file_id)
+            return True
+        except DiskFull as e:
+            debug_log(f"  🟠 {file_id}: deferred to a later run, {e}", self.show_debug)
+            return False
+        except Exception as e:
+            debug_log(f"  🔴 Error downloading file {file_id}: {e}", self.show_debug)
+            return False
+        finally:
+            self.active_downloads.pop(task_name, None)
+            if inflight:
+                del self.inflight[digest]
+                inflight.set()
+            if self.disk:
+                kept = sum(os.path.getsize(f) for f in (out_fname, out_fname + PART_SUFFIX) if os.path.exists(f))
+                await self.disk.release(out_fname, kept)
+
+    async def download_task(self, download_url, out_fname, file_id):
+        success = await self.download_file(download_url, out_fname, file_id)
+        return download_url, out_fname, file_id, success
+
+    def schedule(self, coro):
+        """Run coro as a task that is cancelled if the engine shuts down first"""
+        future = asyncio.ensure_future(coro)
+        self.pending.add(future)
+        future.add_done_callback(self.pending.discard)
+        return future
+
+    async def pipeline(self, produce, queue_size=QUEUE_SIZE):
+        """Download tasks while produce(queue) is still discovering them.
+
+        produce is a coroutine function that puts (url, out_fname, file_id)
+        tasks on the bounded queue it is given; it blocks once queue_size
+        tasks are waiting, so paging never runs far ahead of the downloads.
+        Results are yielded as (url, out_fname, file_id, success) in
+        completion order.
+        """
+        queue = asyncio.Queue(maxsize=queue_size)
+        results = asyncio.Queue()
+        slots = asyncio.Semaphore(self.max_connections)
+
+        async def run_producer():
+            try:
+                await produce(queue)
+            finally:
+                await queue.put(None)
+
+        def on_done(future):
+            slots.release()
+            results.put_nowait(future)
+
+        async def dispatch():
+            running = set()
+            while (task := await queue.get()) is not None:
+                await slots.acquire()
+                future = self.schedule(self.download_task(*task))
+                running.add(future)
+                future.add_done_callback(running.discard)
+                future.add_done_callback(on_done)
+            await asyncio.gather(*running, return_exceptions=True)
+            results.put_nowait(None)
+
+        producer = self.schedule(run_producer())
+        dispatcher = self.schedule(dispatch())
+        try:
+            while (future := await results.get()) is not None:
+                yield future.result()
+            await producer  # Surface errors raised while paging
+        finally:
+            producer.cancel()
+            dispatcher.cancel()
@@ -0,0 +1,69 @@
+import os
+import json
+
+# Constants and Configuration
+FILE_ID_CACHE = "cache/telegram_file_ids.json"
+
+def debug_log(msg, show_debug=True):
+    if show_debug:
+        print(msg)
+
+def sent_media(message):
+    """(file_id, 'image' or 'video') of the media in a sent message, or None"""
+    if message.photo:
+        return message.photo[-1].file_id, 'image'  # Largest size
+    for media in (message.video, message.animation):
+        if media:
+            return media.file_id, 'video'
+    return None
+
+class FileIdCache:
+    """Telegram file_ids of media this bot has already uploaded, keyed by content SHA-256.
+
+    A file_id works in any chat for the bot that uploaded it, so a repost or
+    a resend becomes a small API call that names the file instead of
+    uploading its bytes again. Entries are filled in from the messages
+    Telegram sends back and dropped again if Telegram rejects them. The
+    kind of media is kept with each file_id, since a transcoded file may
+    not be sent the way its source would be.
+    """
+
+    def __init__(self, fname=FILE_ID_CACHE, show_debug=True):
+        self.fname = fname
+        self.show_debug = show_debug
+        try:
+            with open(fname, "r") as f:
+                self.entries = json.load(f)
+        except (FileNotFoundError, ValueError):
+            self.entries = {}
+        self.reused = 0
+        self.changed = False
+
+    def get(self, sha256):
+        """(file_id, kind) stored for a file, or None"""
+        entry = self.entries.get(sha256)
+        if not entry:
+            return None
+        self.reused += 1
+        return tuple(entry)
+
+    def record(self, sha256, message):
+        media = sent_media(message)
+        if media and self.entries.get(sha256) != list(media):
+            self.entries[sha256] = list(media)
+            self.changed = True
+
+    def forget(self, sha256):
+        if self.entries.pop(sha256, None):
+            self.changed = True
+
+    def save(self):
+        debug_log(f"🔵 Reused {self.reused} uploads by file_id ({len(self.entries)} known)", self.show_debug)
+        if not self.changed:
+            return
+        os.makedirs(os.path.dirname(self.fname) or ".", exist_ok=True)
+        tmp_fname = f"{self.fname}.tmp"
+        with open(tmp_fname, "w") as f:
+            json.dump(self.entries, f)
+        os.replace(tmp_fname, self.fname)
+        self.changed = False
@@ -0,0 +1,62 @@
+from datetime import timedelta
+from telegram.error import RetryAfter
+from rate_limiter import TokenBucket, MAX_RETRY_AFTER
+
+# Constants and Configuration
+GLOBAL_RATE = 30  # Bot API messages per second across all chats
+GROUP_RATE = 20 / 60  # Messages per second into one group or channel
+GROUP_BURST = 20
+PRIVATE_RATE = 1  # Messages per second into one private chat
+MAX_FLOOD_RETRIES = 5
+
+def debug_log(msg, show_debug=True):
+    if show_debug:
+        print(msg)
+
+def retry_seconds(retry_after):
+    """RetryAfter.retry_after is an int or a timedelta depending on the library version"""
+    if isinstance(retry_after, timedelta):
+        retry_after = retry_after.total_seconds()
+    return min(float(retry_after), MAX_RETRY_AFTER)
+
+class FloodControl:
+    """Telegram flood limits: one global bucket plus one bucket per chat.
+
+    Every Bot API call waits for a token from both, an album for one token
+    per message it posts. A RetryAfter pauses and slows the chat's bucket
+    for the time Telegram asked for, and the call is made again, up to
+    MAX_FLOOD_RETRIES times.
+    """
+
+    def __init__(self, show_debug=True):
+        self.show_debug = show_debug
+        self.global_bucket = None  # Created on first use, buckets need the running loop
+        self.chats = {}
+
+    def bucket(self, chat_id):
+        if chat_id not in self.chats:
+            if str(chat_id).startswith(('-', '@')):
+                self.chats[chat_id] = TokenBucket(GROUP_RATE, GROUP_BURST)
+            else:
+                self.chats[chat_id] = TokenBucket(PRIVATE_RATE)
+        return self.chats[chat_id]
+
+    async def call(self, chat_id, request, cost=1):
+        """Await request() once the chat and global limits allow cost messages, retrying on flood waits"""
+        if self.global_bucket is None:
+            self.global_bucket = TokenBucket(GLOBAL_RATE, GLOBAL_RATE)
+        bucket = self.bucket(chat_id)
+        for attempt in range(MAX_FLOOD_RETRIES + 1):
+            await bucket.acquire(cost)
+            await self.global_bucket.acquire(cost)
+            try:
+                result = await request()
+            except RetryAfter as e:
+                if attempt == MAX_FLOOD_RETRIES:
+                    raise
+                delay = retry_seconds(e.retry_after)
+                bucket.throttled(delay)
+                debug_log(f"  🟠 Flood wait for chat {chat_id}, retrying in {delay:.0f}s", self.show_debug)
+                continue
+            bucket.succeeded()
+            return result
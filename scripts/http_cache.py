@@ -0,0 +1,64 @@
+import os
+import json
+from urllib.parse import urlencode
+
+def debug_log(msg, show_debug=True):
+    if show_debug:
+        print(msg)
+
+class HttpCache:
+    """ETag / Last-Modified validators and parsed bodies of API listing pages.
+
+    headers() gives the conditional request headers for a page we have seen
+    before; on a 304 the stored body is handed back without reading or
+    decoding anything. Entries live in one JSON file per source, and only
+    the pages requested during this run are written back, so the file stays
+    the size of a single crawl.
+    """
+
+    def __init__(self, fname, show_debug=True):
+        self.fname = fname
+        self.show_debug = show_debug
+        try:
+            with open(fname, "r") as f:
+                self.entries = json.load(f)
+        except (FileNotFoundError, ValueError):
+            self.entries = {}
+        self.used = {}
+        self.requests = 0
+        self.hits = 0
+
+    @staticmethod
+    def key(url, params=None):
+        return f"{url}?{urlencode(sorted(params.items()))}" if params else url
+
+    def headers(self, key):
+        """Conditional request headers for a page, empty if we have no validators"""
+        self.requests += 1
+        entry = self.entries.get(key, {})
+        headers = {}
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def hit(self, key):
+        """Return the stored body for a page the server answered with 304"""
+        self.hits += 1
+        self.used[key] = self.entries[key]
+        return self.entries[key]['body']
+
+    def store(self, key, headers, body):
+        etag = headers.get('ETag')
+        last_modified = headers.get('Last-Modified')
+        if etag or last_modified:
+            self.used[key] = self.entries[key] = {'etag': etag, 'last_modified': last_modified, 'body': body}
+
+    def save(self):
+        if self.requests:
+            debug_log(f"🔵 {self.hits} of {self.requests} listing pages were unchanged (304)", self.show_debug)
+        tmp_fname = f"{self.fname}.tmp"
+        with open(tmp_fname, "w") as f:
+            json.dump(self.used, f)
+        os.replace(tmp_fname, self.fname)
@@ -0,0 +1,245 @@
+import os
+import json
+import mmap
+import struct
+import hashlib
+from array import array
+from bloom_filter import BloomFilter
+
+# Constants and Configuration
+MAGIC = b'IDS1'
+HEADER = struct.Struct('<4sxxxxqq')  # magic, count, capacity
+SLOT = struct.Struct('<q')
+MIN_CAPACITY = 1024  # Slots in a fresh table (power of two)
+MAX_LOAD = 0.5  # Grow the table once it is this full
+COMPACT_EVERY = 10000  # Merge the log into the table once it holds this many IDs
+
+def debug_log(msg, show_debug=True):
+    if show_debug:
+        print(msg)
+
+def id_key(item):
+    """Map an ID of any type to a non-zero signed 64-bit key (0 marks an empty slot)"""
+    key, = SLOT.unpack(hashlib.blake2b(str(item).encode(), digest_size=8).digest())
+    return key or 1
+
+class IdStore:
+    """Set of already-downloaded IDs kept on disk instead of in a JSON list.
+
+    <path>.idx is an open-addressing hash table of 64-bit keys that is
+    mmap'd, so opening it costs nothing and a lookup touches one or two
+    pages. New IDs go to <path>.log, an append-only file of raw keys that
+    is small enough to load into a set. Once the log holds COMPACT_EVERY
+    IDs it is merged into the table in place (rebuilding the table only
+    when it needs to grow) and truncated. A leftover <path>.json from the
+    old format is migrated on first open.
+
+    With prefilter on, a Bloom filter of the table is kept in <path>.bloom
+    and is all that gets loaded up front: the table is only mapped once a
+    key passes the filter, so most misses never touch it.
+    """
+
+    def __init__(self, path, prefilter=True, show_debug=True):
+        self.path = path
+        self.idx_fname = f"{path}.idx"
+        self.log_fname = f"{path}.log"
+        self.bloom_fname = f"{path}.bloom"
+        self.show_debug = show_debug
+        self.file = None
+        self.table = None
+        self.bloom = None
+
+        if not os.path.exists(self.idx_fname):
+            self.migrate(f"{path}.json")
+        self.read_header()
+        if prefilter:
+            self.load_bloom()
+        else:
+            self.open_table()
+        self.new = self.read_log()
+        self.log = open(self.log_fname, "ab")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def __len__(self):
+        return self.count + len(self.new)
+
+    def __contains__(self, item):
+        key = id_key(item)
+        return key in self.new or self.lookup(key)
+
+    def read_header(self):
+        """Read the table's count and capacity without mapping it"""
+        if not os.path.exists(self.idx_fname):
+            self.write_table(array('q', bytes(8 * MIN_CAPACITY)), 0)
+        with open(self.idx_fname, "rb") as f:
+            magic, self.count, self.capacity = HEADER.unpack(f.read(HEADER.size))
+        if magic != MAGIC:
+            raise ValueError(f"{self.idx_fname} is not an ID store")
+        self.mask = self.capacity - 1
+
+    def open_table(self):
+        if self.table is not None:
+            return
+        if not os.path.exists(self.idx_fname):
+            self.write_table(array('q', bytes(8 * MIN_CAPACITY)), 0)
+        self.file = open(self.idx_fname, "r+b")
+        self.table = mmap.mmap(self.file.fileno(), 0)
+        magic, self.count, self.capacity = HEADER.unpack_from(self.table)
+        if magic != MAGIC:
+            raise ValueError(f"{self.idx_fname} is not an ID store")
+        self.mask = self.capacity - 1
+
+    def close_table(self):
+        if self.table is not None:
+            self.table.close()
+            self.file.close()
+            self.table = None
+
+    def load_bloom(self):
+        """Load the saved filter, rebuilding it if it does not match the table"""
+        self.bloom, tag = BloomFilter.load(self.bloom_fname)
+        if self.bloom is None or tag != (self.count, self.capacity):
+            self.open_table()
+            keys = array('q')
+            keys.frombytes(self.table[HEADER.size:])
+            self.build_bloom(key for key in keys if key)
+            debug_log(f"🔵 Rebuilt {self.bloom_fname} for {self.count} IDs", self.show_debug)
+
+    def build_bloom(self, keys):
+        self.bloom = BloomFilter.for_keys(int(self.capacity * MAX_LOAD))
+        for key in keys:
+            self.bloom.add(key)
+        self.save_bloom()
+
+    def save_bloom(self):
+        self.bloom.save(self.bloom_fname, (self.count, self.capacity))
+
+    def write_table(self, slots, count):
+        """Write a complete table to a temporary file and swap it in"""
+        tmp_fname = f"{self.idx_fname}.tmp"
+        with open(tmp_fname, "wb") as f:
+            f.write(HEADER.pack(MAGIC, count, len(slots)))
+            slots.tofile(f)
+        os.replace(tmp_fname, self.idx_fname)
+
+    def read_log(self):
+        try:
+            with open(self.log_fname, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return set()
+        keys = array('q')
+        keys.frombytes(data[:len(data) - len(data) % SLOT.size])  # Drop a torn final write
+        return set(keys)
+
+    def lookup(self, key):
+        if self.bloom is not None and key not in self.bloom:
+            return False
+        self.open_table()
+        slot = key & self.mask
+        while True:
+            value, = SLOT.unpack_from(self.table, HEADER.size + 8 * slot)
+            if value == key:
+                return True
+            if value == 0:
+                return False
+            slot = (slot + 1) & self.mask
+
+    def insert(self, key):
+        """Put a key into the mmap'd table, returning False if it was already there"""
+        slot = key & self.mask
+        while True:
+            offset = HEADER.size + 8 * slot
+            value, = SLOT.unpack_from(self.table, offset)
+            if value == key:
+                return False
+            if value == 0:
+                SLOT.pack_into(self.table, offset, key)
+                return True
+            slot = (slot + 1) & self.mask
+
+    def update(self, ids):
+        """Record IDs as seen; only the new keys are appended to the log"""
+        keys = array('q')
+        for item in ids:
+            key = id_key(item)
+            if key not in self.new and not self.lookup(key):
+                self.new.add(key)
+                keys.append(key)
+        if keys:
+            keys.tofile(self.log)
+            self.log.flush()
+        if len(self.new) >= COMPACT_EVERY:
+            self.compact()
+
+    def compact(self):
+        """Merge the log into the table and truncate it"""
+        if not self.new:
+            return
+        total = self.count + len(self.new)
+        if total > self.capacity * MAX_LOAD:
+            self.grow(total)
+        else:
+            self.open_table()
+            for key in self.new:
+                self.count += self.insert(key)
+            HEADER.pack_into(self.table, 0, MAGIC, self.count, self.capacity)
+            self.table.flush()
+            if self.bloom is not None:
+                for key in self.new:
+                    self.bloom.add(key)
+                self.save_bloom()
+        debug_log(f"🔵 Compacted {len(self.new)} new IDs into {self.idx_fname} ({self.count} total)", self.show_debug)
+        self.new.clear()
+        self.log.truncate(0)
+
+    def grow(self, total):
+        """Rebuild the table with room for `total` keys at MAX_LOAD"""
+        capacity = self.capacity
+        while total > capacity * MAX_LOAD:
+            capacity *= 2
+        self.open_table()
+        old = array('q')
+        old.frombytes(self.table[HEADER.size:])
+        keys = self.new.union(key for key in old if key)
+        self.close_table()
+
+        mask = capacity - 1
+        slots = array('q', bytes(8 * capacity))
+        for key in keys:
+            slot = key & mask
+            while slots[slot]:
+                slot = (slot + 1) & mask
+            slots[slot] = key
+        self.write_table(slots, len(keys))
+        self.read_header()
+        if self.bloom is not None:
+            self.build_bloom(keys)
+
+    def migrate(self, json_fname):
+        """Import a legacy JSON list of IDs, then remove it"""
+        try:
+            with open(json_fname, "r") as f:
+                ids = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return
+        self.open_table()
+        self.new = self.read_log()
+        self.new.update(id_key(item) for item in ids)
+        self.log = open(self.log_fname, "ab")
+        self.compact()
+        self.log.close()
+        self.close_table()
+        os.remove(json_fname)
+        debug_log(f"🟢 Migrated {len(ids)} IDs from {json_fname} to {self.idx_fname}", self.show_debug)
+
+    def close(self):
+        if len(self.new) >= COMPACT_EVERY:
+            self.compact()
+        self.log.close()
+        self.close_table()
@@ -0,0 +1,107 @@
+import os
+import re
+import glob
+import time
+import sqlite3
+import threading
+from urllib.parse import urlsplit
+from blob_store import file_sha256
+
+# Constants and Configuration
+INDEX_DIR = "cache"  # Holds one media_index_<source>.db per script
+URL_HASHES = {64: 'sha256', 32: 'md5'}  # Coomer/Kemono name files by SHA-256, Rule34 by MD5
+HEX_NAME = re.compile(r'[0-9a-f]+')
+
+def url_hash(url):
+    """(algorithm, hex digest) the server put in the file name, or None"""
+    stem = os.path.splitext(os.path.basename(urlsplit(url).path))[0].lower()
+    kind = URL_HASHES.get(len(stem))
+    return (kind, stem) if kind and HEX_NAME.fullmatch(stem) else None
+
+def index_file(source, root=INDEX_DIR):
+    return os.path.join(root, f"media_index_{source}.db")
+
+class MediaIndex:
+    """Index of every file mirrored by any of the scripts, keyed by content SHA-256.
+
+    Each script writes its own cache/media_index_<source>.db and attaches the
+    other scripts' files read-only, so the same media reached through Rule34
+    and Coomer, or cross-posted between subreddits, is kept and uploaded
+    once. The jobs run in parallel and each one only saves its own file, so
+    no job overwrites another's rows. find_url() is the cheap pre-check: it
+    matches the hash in the file name before anything is downloaded. add()
+    hashes a finished file and reports the earlier copy if the content is
+    already known.
+    """
+
+    def __init__(self, source, root=INDEX_DIR):
+        os.makedirs(root, exist_ok=True)
+        fname = index_file(source, root)
+        self.source = source
+        self.lock = threading.Lock()  # add() runs in worker threads
+        self.db = sqlite3.connect(f"file:{fname}", uri=True, check_same_thread=False)  # uri lets ATTACH open the others read-only
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS media (
+                sha256 TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                server_hash TEXT,
+                source TEXT NOT NULL,
+                path TEXT NOT NULL,
+                added REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS media_server_hash ON media (server_hash);
+        """)
+        self.schemas = ["main"]
+        for other in sorted(glob.glob(index_file("*", root))):
+            if os.path.samefile(other, fname):
+                continue
+            schema = f"other{len(self.schemas)}"
+            self.db.execute(f"ATTACH DATABASE ? AS {schema}", (f"file:{other}?mode=ro",))
+            try:
+                self.db.execute(f"SELECT 1 FROM {schema}.media LIMIT 1")
+            except sqlite3.DatabaseError:
+                self.db.execute(f"DETACH DATABASE {schema}")  # Empty or damaged, nothing to match against
+                continue
+            self.schemas.append(schema)
+
+    def lookup(self, column, value):
+        """Path stored for value in this index or any attached one, or None; call with the lock held"""
+        for schema in self.schemas:
+            row = self.db.execute(f"SELECT path FROM {schema}.media WHERE {column} = ?", (value,)).fetchone()
+            if row:
+                return row[0]
+        return None
+
+    def find_url(self, url):
+        """Path of an already mirrored file whose hash is in the URL, or None"""
+        found = url_hash(url)
+        if not found:
+            return None
+        kind, digest = found
+        with self.lock:
+            if kind == 'sha256':
+                return self.lookup("sha256", digest)
+            return self.lookup("server_hash", f"{kind}:{digest}")
+
+    def find(self, sha256):
+        with self.lock:
+            return self.lookup("sha256", sha256)
+
+    def add(self, fname, sha256=None, url=None):
+        """Record a finished file; returns the path of an earlier copy if the content is already known"""
+        sha256 = sha256 or file_sha256(fname)
+        found = url_hash(url) if url else None
+        server_hash = f"{found[0]}:{found[1]}" if found else None
+        with self.lock:
+            path = self.lookup("sha256", sha256)
+            if path:
+                return path if path != fname else None
+            self.db.execute(
+                "INSERT INTO media VALUES (?, ?, ?, ?, ?, ?)",
+                (sha256, os.path.getsize(fname), server_hash, self.source, fname, time.time())
+            )
+            self.db.commit()
+        return None
+
+    def close(self):
+        self.db.close()
@@ -0,0 +1,72 @@
+import os
+import json
+import time
+
+# Constants and Configuration
+DONE_SUFFIX = ".done"  # Created when the writer has finished
+FOLLOW_INTERVAL = 1  # seconds between polls while following a live file
+FOLLOW_IDLE_TIMEOUT = 600  # Stop following once the file hasn't changed for this long
+
+def debug_log(msg, show_debug=True):
+    if show_debug:
+        print(msg)
+
+class MetadataSink:
+    """Append-only JSONL metadata file, one entry per line.
+
+    Each entry is written and flushed as soon as it is appended, so a crash
+    keeps everything finished so far and a reader can follow the file while
+    it grows. close() drops a <fname>.done marker for followers.
+    """
+
+    def __init__(self, fname):
+        self.fname = fname
+        self.count = 0
+        if os.path.exists(f"{fname}{DONE_SUFFIX}"):
+            os.remove(f"{fname}{DONE_SUFFIX}")
+        self.file = open(fname, "w")
+
+    def __len__(self):
+        return self.count
+
+    def append(self, entry):
+        self.file.write(json.dumps(entry) + "\n")
+        self.file.flush()
+        self.count += 1
+
+    def close(self):
+        self.file.close()
+        open(f"{self.fname}{DONE_SUFFIX}", "w").close()
+
+def read_metadata(fname, follow=False, idle_timeout=FOLLOW_IDLE_TIMEOUT, show_debug=True):
+    """Yield metadata entries one at a time from a JSONL file (or a legacy JSON array).
+
+    With follow, keep waiting for new lines until the writer's .done marker
+    appears, so entries can be consumed while the downloader is running.
+    If the file goes idle_timeout seconds without changing, the writer is
+    assumed to have died and reading stops.
+    """
+    with open(fname, "r") as f:
+        first = f.read(1)
+        f.seek(0)
+        if first == "[":
+            yield from json.load(f)
+            return
+
+        pending = ""
+        while True:
+            # Checked before reading, so nothing written before the marker is missed
+            finished = follow and os.path.exists(f"{fname}{DONE_SUFFIX}")
+            line = f.readline()
+            if line.endswith("\n"):
+                line, pending = pending + line, ""
+                if line.strip():
+                    yield json.loads(line)
+                continue
+            pending += line  # A partial line the writer has not finished yet
+            if not follow or finished:
+                break
+            if time.time() - os.path.getmtime(fname) >= idle_timeout:
+                debug_log(f"🟠 {fname} unchanged for {idle_timeout}s without a {DONE_SUFFIX} marker, stopping", show_debug)
+                break
+            time.sleep(FOLLOW_INTERVAL)
@@ -0,0 +1,77 @@
+import io
+import os
+import numpy as np
+from PIL import Image
+
+# Constants and Configuration
+HASH_SIZE = 8  # 8x8 gradient bits -> 64-bit dHash
+MAX_DISTANCE = 4  # Hamming distance still counted as the same picture
+CHUNKS = MAX_DISTANCE + 1  # Pigeonhole: a match this close agrees exactly on at least one chunk
+MIN_BITS = 16  # Hashes with fewer set (or clear) bits than this say too little about the picture
+MIN_CONTRAST = 20  # Grey-level standard deviation of the thumbnail, below it the image is mostly flat
+
+def dhash(source):
+    """64-bit difference hash of an image given as bytes, a path or a file object.
+
+    Returns None for low-detail images such as text on a plain background or
+    a solid first frame: different pictures of that kind hash within a few
+    bits of each other, so only the exact hash can tell them apart.
+    """
+    with Image.open(io.BytesIO(source) if isinstance(source, bytes) else source) as image:
+        small = image.convert("L").resize((HASH_SIZE + 1, HASH_SIZE), Image.LANCZOS)
+    pixels = np.asarray(small, dtype=np.int16)
+    bits = pixels[:, 1:] > pixels[:, :-1]
+    set_bits = int(bits.sum())
+    if min(set_bits, bits.size - set_bits) < MIN_BITS or pixels.std() < MIN_CONTRAST:
+        return None
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+def chunk_masks():
+    """(shift, mask) pairs splitting 64 bits into CHUNKS nearly equal parts"""
+    widths = [64 // CHUNKS + (i < 64 % CHUNKS) for i in range(CHUNKS)]
+    shifts = np.cumsum([0] + widths[:-1])
+    return [(int(shift), (1 << width) - 1) for shift, width in zip(shifts, widths)]
+
+class PerceptualIndex:
+    """Multi-index hash table of dHashes for near-duplicate lookups.
+
+    Each hash is filed under each of its CHUNKS bit ranges. Two hashes within
+    MAX_DISTANCE bits of each other must agree exactly on at least one range,
+    so a lookup only compares against the few hashes sharing a bucket with
+    it. Hashes are saved as a uint64 .npy array.
+    """
+
+    def __init__(self, fname, max_distance=MAX_DISTANCE):
+        self.fname = fname
+        self.max_distance = min(max_distance, MAX_DISTANCE)
+        self.masks = chunk_masks()
+        self.tables = [{} for _ in self.masks]
+        self.hashes = []
+        if os.path.exists(fname):
+            for h in np.load(fname).tolist():
+                self.add(h)
+        self.loaded = len(self.hashes)
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def find(self, h):
+        """Return a stored hash within max_distance of h, or None"""
+        for table, (shift, mask) in zip(self.tables, self.masks):
+            for other in table.get((h >> shift) & mask, ()):
+                if (h ^ other).bit_count() <= self.max_distance:
+                    return other
+        return None
+
+    def add(self, h):
+        self.hashes.append(h)
+        for table, (shift, mask) in zip(self.tables, self.masks):
+            table.setdefault((h >> shift) & mask, []).append(h)
+
+    def save(self):
+        if len(self.hashes) == self.loaded:
+            return
+        tmp_fname = f"{self.fname}.tmp.npy"
+        np.save(tmp_fname, np.array(self.hashes, dtype=np.uint64))
+        os.replace(tmp_fname, self.fname)
+        self.loaded = len(self.hashes)
@@ -0,0 +1,113 @@
+import asyncio
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+from urllib.parse import urlsplit
+
+# Constants and Configuration
+THROTTLE_STATUSES = {429, 503}
+DECREASE_FACTOR = 0.5  # Rate multiplier when a host pushes back
+RECOVERY_STEP = 0.05  # Share of the configured rate won back per successful request
+DECREASE_COOLDOWN = 1.0  # seconds; one burst of 429s only counts once
+MIN_RATE_SHARE = 0.05  # Never drop below 5% of the configured rate
+MAX_RETRY_AFTER = 300  # seconds; ignore absurd Retry-After values
+
+def debug_log(msg, show_debug=True):
+    if show_debug:
+        print(msg)
+
+def parse_retry_after(value):
+    """Return the delay in seconds from a Retry-After header (delta-seconds or HTTP-date)"""
+    if not value:
+        return None
+    try:
+        delay = float(value)
+    except ValueError:
+        try:
+            delay = (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds()
+        except (TypeError, ValueError):
+            return None
+    return min(max(delay, 0), MAX_RETRY_AFTER)
+
+class TokenBucket:
+    """Token bucket for one host whose refill rate adapts to throttling.
+
+    Waiters are served in FIFO order. throttled() halves the rate (at most
+    once per DECREASE_COOLDOWN) and pauses the bucket for Retry-After;
+    succeeded() wins the rate back additively until it reaches the
+    configured ceiling again.
+    """
+
+    def __init__(self, rate, burst=1):
+        self.max_rate = rate
+        self.min_rate = rate * MIN_RATE_SHARE
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.lock = asyncio.Lock()
+        loop = asyncio.get_running_loop()
+        self.updated = loop.time()
+        self.paused_until = 0
+        self.last_decrease = 0
+
+    async def acquire(self, cost=1):
+        """Take cost tokens; a cost above the burst waits for a full bucket and leaves it in debt"""
+        loop = asyncio.get_running_loop()
+        needed = min(cost, self.burst)
+        async with self.lock:
+            while True:
+                now = loop.time()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= needed:
+                    self.tokens -= cost
+                    return
+                await asyncio.sleep((needed - self.tokens) / self.rate)
+
+    def throttled(self, retry_after=None):
+        now = asyncio.get_running_loop().time()
+        if retry_after:
+            self.paused_until = max(self.paused_until, now + retry_after)
+        if now - self.last_decrease >= DECREASE_COOLDOWN:
+            self.rate = max(self.min_rate, self.rate * DECREASE_FACTOR)
+            self.tokens = 0
+            self.updated = max(now, self.paused_until)  # Refill only once the pause is over
+            self.last_decrease = now
+
+    def succeeded(self):
+        self.rate = min(self.max_rate, self.rate + self.max_rate * RECOVERY_STEP)
+
+class RateLimiter:
+    """Shared per-host rate limiter used for both API pages and file fetches"""
+
+    def __init__(self, rate, burst=1, show_debug=True):
+        self.rate = rate  # requests per second per host, None or 0 disables limiting
+        self.burst = burst
+        self.show_debug = show_debug
+        self.buckets = {}
+
+    def bucket(self, url):
+        host = urlsplit(url).netloc
+        if host not in self.buckets:
+            self.buckets[host] = TokenBucket(self.rate, self.burst)
+        return self.buckets[host]
+
+    async def acquire(self, url):
+        """Wait until a request to the url's host is allowed"""
+        if self.rate:
+            await self.bucket(url).acquire()
+
+    def record(self, url, status, headers):
+        """Feed a response back so the host's rate adapts to it"""
+        if not self.rate:
+            return
+        bucket = self.bucket(url)
+        if status in THROTTLE_STATUSES:
+            retry_after = parse_retry_after(headers.get('Retry-After'))
+            bucket.throttled(retry_after)
+            wait = f", waiting {retry_after:.0f}s" if retry_after else ""
+            debug_log(f"  🟠 {urlsplit(url).netloc} returned {status}, slowing to {bucket.rate:.2f} req/s{wait}", self.show_debug)
+        elif status < 400:
+            bucket.succeeded()
@@ -1,16 +1,30 @@
 import os
-import json
 import requests
 import praw
-import subprocess
-import sys
+import yt_dlp
 import argparse
+import hashlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from requests.adapters import HTTPAdapter
 from requests.packages.urllib3.util.retry import Retry
+from id_store import IdStore
+from media_index import MediaIndex
+from metadata_log import MetadataSink
+from blob_store import file_sha256
+from perceptual_hash import PerceptualIndex, dhash
 
 # Constants
 MEME_LIMIT = 250
+SKIPPED = "skipped"  # Post handled without a new meme, doesn't count towards MEME_LIMIT
 VALID_IMAGE_EXTS = ['.png','.jpg','.jpeg','.webp','.gif']
+IMAGE_WORKERS = 16  # Images fetched at the same time
+PENDING_IMAGES = IMAGE_WORKERS * 2  # Listed posts allowed to wait for their image
+IMAGE_CHUNK_SIZE = 64 * 1024
+VIDEO_WORKERS = 4  # yt-dlp downloads running at the same time
+MULTI_LIMIT = 300  # Posts read per combined r/a+b+c listing (3 API pages)
+MULTI_ROUNDS = 3  # Combined listings before falling back to one request per subreddit
+MULTI_MAX_QUOTA = 25  # Above this --post-limit, one request per subreddit is cheaper
 SUBREDDITS = [
     "Memes", "ProgrammerHumor", "DankMemes", "DirtyMemes", 
     "RareInsults", "Funny", "Science", "TodayILearned", 
@@ -36,25 +50,112 @@ def debug_log(msg, show_debug=True):
 def setup_session():
     session = requests.Session()
     retry = Retry(total=3, backoff_factor=1, status_forcelist=[502, 503, 504])
-    adapter = HTTPAdapter(max_retries=retry)
+    adapter = HTTPAdapter(max_retries=retry, pool_maxsize=IMAGE_WORKERS)
     session.mount('http://', adapter)
     session.mount('https://', adapter)
     return session
 
-def process_image_post(post, session, memes_metadata, new_ids, show_debug=True):
+def list_new_posts(reddit, subreddits, post_limit, show_debug=True):
+    """Newest post_limit posts of every subreddit, read through combined listings.
+
+    Gives the same posts, in the same order, as one subreddit(...).new() call
+    per subreddit. Each round lists every subreddit still short of its quota
+    as one r/a+b+c listing, so busy subreddits fill up in the first round and
+    quiet ones get the next round to themselves; whatever is still short
+    after MULTI_ROUNDS is listed on its own.
+    """
+    names = {name.lower(): name for name in subreddits}
+    posts = {name: [] for name in subreddits}
+    seen = set()
+    remaining = list(subreddits) if post_limit <= MULTI_MAX_QUOTA else []
+    fallback = [] if remaining else list(subreddits)
+
+    for round_number in range(1, MULTI_ROUNDS + 1):
+        if not remaining:
+            break
+        listed = 0
+        for post in reddit.subreddit("+".join(remaining)).new(limit=MULTI_LIMIT):
+            listed += 1
+            name = names.get(post.subreddit.display_name.lower())
+            if name is None or post.id in seen or len(posts[name]) >= post_limit:
+                continue
+            seen.add(post.id)
+            posts[name].append(post)
+            if all(len(posts[n]) >= post_limit for n in remaining):
+                break
+        exhausted = listed < MULTI_LIMIT  # Every listed subreddit ran out of posts
+        remaining = [] if exhausted else [n for n in remaining if len(posts[n]) < post_limit]
+        debug_log(f"🟢 Listing round {round_number}: read {listed} posts, {len(remaining)} subreddits still short", show_debug)
+
+    for name in fallback + remaining:
+        try:
+            posts[name] = list(reddit.subreddit(name).new(limit=post_limit))
+        except Exception as e:
+            debug_log(f"🔴 Failed to list r/{name}: {e}", show_debug)
+    return posts
+
+def fetch_image(url, out_fname, session):
+    """Stream an image to a .part file, returning its SHA-256 and perceptual hash"""
+    part_fname = f"{out_fname}.part"
+    sha256 = hashlib.sha256()
+    try:
+        with session.get(url, timeout=10, stream=True) as r:
+            r.raise_for_status()
+            with open(part_fname, "wb") as f:
+                for chunk in r.iter_content(IMAGE_CHUNK_SIZE):
+                    sha256.update(chunk)
+                    f.write(chunk)
+    except Exception:
+        if os.path.exists(part_fname):
+            os.remove(part_fname)
+        raise
+
     try:
-        ext = os.path.splitext(post.url.lower())[1]
-        if ext not in VALID_IMAGE_EXTS:
-            return False
-
-        debug_log(f"  🟡 Found image post: {post.id}", show_debug)
-        r = session.get(post.url, timeout=10)
-        r.raise_for_status()
-        out_fname = os.path.join("cache", f"{post.id}{ext}")
-        
-        with open(out_fname, "wb") as f:
-            f.write(r.content)
-        
+        phash = dhash(part_fname)
+    except (OSError, ValueError):
+        phash = None  # Not decodable here, rely on the exact hash
+    return part_fname, sha256.hexdigest(), phash
+
+def submit_image_post(post, session, pool, show_debug=True):
+    """Start fetching an image post in the pool; None if the post is not an image"""
+    ext = os.path.splitext(post.url.lower())[1]
+    if ext not in VALID_IMAGE_EXTS:
+        return None
+
+    debug_log(f"  🟡 Found image post: {post.id}", show_debug)
+    out_fname = os.path.join("cache", f"{post.id}{ext}")
+    return pool.submit(fetch_image, post.url, out_fname, session)
+
+def process_image_post(post, future, memes_metadata, new_ids, index, phashes, show_debug=True):
+    """Finish a fetched image post in listing order: dedup it and record its metadata.
+
+    Returns True for a new meme, SKIPPED for a duplicate and False if the
+    post isn't an image that could be fetched.
+    """
+    if future is None:
+        return False
+    try:
+        part_fname, sha256, phash = future.result()
+        out_fname = part_fname[:-len(".part")]
+
+        duplicate = index.find(sha256)
+        if duplicate:
+            os.remove(part_fname)
+            debug_log(f"    🔵 Same image as {duplicate}, skipping", show_debug)
+            new_ids.append(post.id)
+            return SKIPPED
+
+        if phash is not None and phashes.find(phash) is not None:
+            os.remove(part_fname)
+            debug_log("    🔵 Near-duplicate of an earlier meme, skipping", show_debug)
+            new_ids.append(post.id)
+            return SKIPPED
+
+        os.replace(part_fname, out_fname)
+        index.add(out_fname, sha256, post.url)
+        if phash is not None:
+            phashes.add(phash)
+
         memes_metadata.append({
             "id": post.id,
             "title": post.title,
@@ -62,6 +163,7 @@ def process_image_post(post, session, memes_metadata, new_ids, show_debug=True):
             "subreddit": str(post.subreddit),
             "upvotes": post.ups,
             "filename": os.path.basename(out_fname),
+            "sha256": sha256,
             "type": "image"
         })
         new_ids.append(post.id)
@@ -71,24 +173,51 @@ def process_image_post(post, session, memes_metadata, new_ids, show_debug=True):
         debug_log(f"  🔴 Error processing post {post.id}: {e}", show_debug)
         return False
 
-def process_video_post(post, memes_metadata, new_ids, show_debug=True):
+class QuietLogger:
+    """Swallow yt-dlp output, like running it with --quiet and stderr on devnull"""
+    def debug(self, msg):
+        pass
+
+    def warning(self, msg):
+        pass
+
+    def error(self, msg):
+        pass
+
+def fetch_video(url, outtmpl):
+    """Download a video with an in-process YoutubeDL, returning (filename, sha256) or None"""
+    files = []
+    options = {
+        'quiet': True,
+        'no_warnings': True,
+        'noprogress': True,
+        'ignoreerrors': True,
+        'format': 'best',
+        'merge_output_format': 'mp4',
+        'outtmpl': outtmpl,
+        'logger': QuietLogger(),
+        'post_hooks': [files.append],  # Called with the final filename after merging
+    }
+    with yt_dlp.YoutubeDL(options) as ydl:
+        ydl.download([url])
+    if not files or not os.path.exists(files[-1]):
+        return None
+    downloaded_file = os.path.relpath(files[-1])
+    return downloaded_file, file_sha256(downloaded_file)
+
+def process_video_post(post, future, memes_metadata, new_ids, index, show_debug=True):
+    """Finish a video post in listing order: dedup it and record its metadata (SKIPPED for a duplicate)"""
     try:
-        outtmpl = f"cache/{post.id}.%(ext)s"
-        with open(os.devnull, 'w') as devnull:
-            result = subprocess.run([
-                sys.executable, '-m', 'yt_dlp', '--quiet', '--no-warnings', 
-                '--ignore-errors', '--format', 'best', 
-                '--merge-output-format', 'mp4', '--output', outtmpl, 
-                post.url
-            ], stdout=devnull, stderr=devnull)
-
-        downloaded_file = None
-        for file in os.listdir("cache"):
-            if file.startswith(post.id):
-                downloaded_file = os.path.join("cache", file)
-                break
+        result = future.result()
+        if result:
+            downloaded_file, sha256 = result
+            duplicate = index.add(downloaded_file, sha256)
+            if duplicate:
+                os.remove(downloaded_file)
+                debug_log(f"  🔵 Same video as {duplicate}, skipping", show_debug)
+                new_ids.append(post.id)
+                return SKIPPED
 
-        if downloaded_file:
             debug_log(f"  🟡 Downloaded video: {downloaded_file}", show_debug)
             memes_metadata.append({
                 "id": post.id,
@@ -97,6 +226,7 @@ def process_video_post(post, memes_metadata, new_ids, show_debug=True):
                 "subreddit": str(post.subreddit),
                 "upvotes": post.ups,
                 "filename": os.path.basename(downloaded_file),
+                "sha256": sha256,
                 "type": "video"
             })
             new_ids.append(post.id)
@@ -118,61 +248,90 @@ def main():
     debug_log("🟢 Reddit instance created.", args.debug)
     
     # Load cache
-    cache_file = "cache/meme_ids.json"
-    try:
-        with open(cache_file, "r") as f:
-            cached_ids = set(json.load(f))
-        debug_log("🟢 Loaded cached Meme IDs.", args.debug)
-    except:
-        cached_ids = set()
-        debug_log("🔴 No cache found. Starting fresh.", args.debug)
+    cache_file = "cache/meme_ids"
+    cached_ids = IdStore(cache_file, show_debug=args.debug)
+    debug_log(f"🟢 Loaded {len(cached_ids)} cached Meme IDs.", args.debug)
+    index = MediaIndex(source="reddit")
+    phashes = PerceptualIndex("cache/meme_phashes.npy")
+    debug_log(f"🟢 Loaded {len(phashes)} perceptual hashes.", args.debug)
 
     session = setup_session()
     total_memes = 0
     new_ids = []
-    memes_metadata = []
+    memes_metadata = MetadataSink("cache/memes_metadata.jsonl")  # Each entry is on disk as soon as it is final
     video_posts = []
+    pending = deque()  # (post, image future or None) in listing order
 
-    # Process subreddits
-    for subreddit in SUBREDDITS:
-        if total_memes >= MEME_LIMIT:
-            debug_log("🔴 Meme limit reached. Stopping download.", args.debug)
-            break
-            
-        debug_log(f"🟢 Scraping r/{subreddit} for new posts...", args.debug)
-        for post in reddit.subreddit(subreddit).new(limit=args.post_limit):
-            if not args.disable_cache and post.id in cached_ids:
-                debug_log(f"  🔵 Skipping cached post: {post.id}", args.debug)
-                continue
-
-            if process_image_post(post, session, memes_metadata, new_ids, args.debug):
-                total_memes += 1
-            else:
-                debug_log(f"  🟠 Found potential video post: {post.id}", args.debug)
-                video_posts.append(post)
+    def settle():
+        """Finish the oldest listed post, so results keep the listing order"""
+        nonlocal total_memes
+        post, future = pending.popleft()
+        result = process_image_post(post, future, memes_metadata, new_ids, index, phashes, args.debug)
+        if result is SKIPPED:
+            return
+        if result:
+            total_memes += 1
+        else:
+            debug_log(f"  🟠 Found potential video post: {post.id}", args.debug)
+            video_posts.append(post)
 
+    # List every subreddit up front, then fetch images in the pool
+    listings = list_new_posts(reddit, SUBREDDITS, args.post_limit, args.debug)
+    with ThreadPoolExecutor(max_workers=IMAGE_WORKERS) as pool:
+        for subreddit in SUBREDDITS:
             if total_memes >= MEME_LIMIT:
+                debug_log("🔴 Meme limit reached. Stopping download.", args.debug)
                 break
 
-    # Process video posts
-    for post in video_posts:
-        if total_memes >= MEME_LIMIT:
-            break
-        if process_video_post(post, memes_metadata, new_ids, args.debug):
+            debug_log(f"🟢 Processing new posts from r/{subreddit}...", args.debug)
+            for post in listings[subreddit]:
+                if not args.disable_cache and post.id in cached_ids:
+                    debug_log(f"  🔵 Skipping cached post: {post.id}", args.debug)
+                    continue
+
+                pending.append((post, submit_image_post(post, session, pool, args.debug)))
+                # Never have more in flight than could still count towards MEME_LIMIT
+                while pending and (len(pending) >= PENDING_IMAGES or total_memes + len(pending) >= MEME_LIMIT):
+                    settle()
+
+                if total_memes >= MEME_LIMIT:
+                    break
+
+        while pending:
+            settle()
+
+    # Process video posts in an in-process yt-dlp pool
+    videos = deque()  # (post, future) in listing order
+
+    def settle_video():
+        nonlocal total_memes
+        post, future = videos.popleft()
+        if process_video_post(post, future, memes_metadata, new_ids, index, args.debug) is True:
             total_memes += 1
 
+    with ThreadPoolExecutor(max_workers=VIDEO_WORKERS) as pool:
+        for post in video_posts:
+            while videos and total_memes + len(videos) >= MEME_LIMIT:
+                settle_video()
+            if total_memes >= MEME_LIMIT:
+                break
+            videos.append((post, pool.submit(fetch_video, post.url, f"cache/{post.id}.%(ext)s")))
+
+        while videos:
+            settle_video()
+
     # Update cache and save metadata
     if new_ids:
         cached_ids.update(new_ids)
-        with open(cache_file, "w") as f:
-            json.dump(sorted(cached_ids), f)
         debug_log(f"🟢 Downloaded {len(new_ids)} new items.", args.debug)
     else:
         debug_log("🟠 No New Items Found!", args.debug)
+    cached_ids.close()
+    index.close()
+    phashes.save()
 
-    with open("cache/memes_metadata.json", "w") as f:
-        json.dump(memes_metadata, f, indent=2)
-    debug_log("🟢 Memes metadata collected.", args.debug)
+    memes_metadata.close()
+    debug_log(f"🟢 Memes metadata collected ({len(memes_metadata)} entries).", args.debug)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -1,17 +1,36 @@
 import os
 import re
-import json
 import asyncio
 import argparse
-from telegram import Bot
+from telegram import Bot, InputMediaPhoto, InputMediaVideo
+from telegram.error import BadRequest
+from telegram.request import HTTPXRequest
+from metadata_log import read_metadata
+from flood_control import FloodControl
+from file_id_cache import FileIdCache, FILE_ID_CACHE
+from blob_store import file_sha256
+from transcoder import Transcoder
+
+# Constants and Configuration
+SEND_WORKERS = 8  # Uploads in flight at once
+UPLOAD_TIMEOUT = 120  # seconds to push one media file to the Bot API
+READ_TIMEOUT = 60  # seconds to wait for Telegram to answer a finished upload
+ALBUM_SIZE = 10  # Bot API maximum items per sendMediaGroup
 
 def parse_args():
     parser = argparse.ArgumentParser(description='Telegram Meme Sender')
     parser.add_argument('--debug', action='store_true', help='Enable debug logging')
     parser.add_argument('--token', required=True, help='Telegram Bot Token')
-    parser.add_argument('--chat-id', required=True, help='Telegram Chat ID')
-    parser.add_argument('--metadata', default='cache/memes_metadata.json', 
+    parser.add_argument('--chat-id', required=True, nargs='+',
+                       help='Telegram Chat ID, or several (space or comma separated) to mirror every meme to')
+    parser.add_argument('--metadata', default='cache/memes_metadata.jsonl', 
                        help='Path to metadata file')
+    parser.add_argument('--file-ids', default=FILE_ID_CACHE, help='Path to the cache of uploaded Telegram file_ids')
+    parser.add_argument('--transcode', action='store_true', help='Shrink large images, GIFs and videos before uploading them')
+    parser.add_argument('--follow', action='store_true', help='Keep sending while the downloader is still writing metadata')
+    parser.add_argument('--workers', type=int, default=SEND_WORKERS, help='Number of memes uploaded at once')
+    parser.add_argument('--album-size', type=int, default=ALBUM_SIZE, help='Memes per media group, 1 sends every meme on its own')
+    parser.add_argument('--ordered', action='store_true', help='Send one meme at a time so the chat keeps the metadata order')
     return parser.parse_args()
 
 def debug_log(msg, show_debug=True):
@@ -37,31 +56,116 @@ def build_caption(meme):
 👍 *Upvotes:* {meme.get('upvotes', '0')}
 🏷️ *Subreddit:* r/{escape_markdown(meme.get('subreddit', '?'))}"""
 
-async def send_meme_async(bot, meme, chat_id, show_debug=True):
+def read_file(file_path):
+    with open(file_path, 'rb') as f:
+        return f.read()
+
+async def load_media(meme, file_ids, transcoder=None, upload=False):
+    """(sha256, media, kind, filename) for a meme: a known file_id, or the bytes to upload"""
     file_path = os.path.join('cache', meme['filename'])
+    sha256 = meme.get('sha256') or await asyncio.to_thread(file_sha256, file_path)
+    known = None if upload else file_ids.get(sha256)
+    if known:
+        file_id, kind = known
+        return sha256, file_id, kind, os.path.basename(file_path)
+    kind = meme['type']
+    if transcoder:
+        file_path, kind = await transcoder.prepare(file_path, sha256, kind)
+    data = await asyncio.to_thread(read_file, file_path)
+    return sha256, data, kind, os.path.basename(file_path)
+
+def batch_memes(memes, size):
+    """Group consecutive image and video memes into albums of up to size items"""
+    batch = []
+    for meme in memes:
+        if meme['type'] not in ('image', 'video'):
+            if batch:
+                yield batch
+                batch = []
+            yield [meme]
+            continue
+        batch.append(meme)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def input_media(meme, media, kind, filename):
+    caption = build_caption(meme)
+    if kind == 'image':
+        return InputMediaPhoto(media, caption=caption, parse_mode='Markdown', filename=filename)
+    return InputMediaVideo(media, caption=caption, parse_mode='Markdown', filename=filename, supports_streaming=True)
+
+async def send_meme_async(bot, meme, chat_id, flood, file_ids, transcoder=None, show_debug=True):
+    """Send one meme; returns True on success. The bytes are kept so a flood wait can resend them."""
     caption = build_caption(meme)
+
+    def send(media, kind, filename):
+        if kind == 'image':
+            return bot.send_photo(
+                chat_id=chat_id,
+                photo=media,
+                filename=filename,
+                caption=caption,
+                parse_mode='Markdown'
+            )
+        return bot.send_video(
+            chat_id=chat_id,
+            video=media,
+            filename=filename,
+            caption=caption,
+            parse_mode='Markdown',
+            supports_streaming=True
+        )
+
+    if meme['type'] not in ('image', 'video'):
+        return True
     try:
-        if meme['type'] == 'image':
-            with open(file_path, 'rb') as img:
-                await bot.send_photo(
-                    chat_id=chat_id,
-                    photo=img,
-                    caption=caption,
-                    parse_mode='Markdown'
-                )
-                debug_log(f"🟢 Sent image Meme ID: {meme['id']}", show_debug)
-        elif meme['type'] == 'video':
-            with open(file_path, 'rb') as vid:
-                await bot.send_video(
-                    chat_id=chat_id,
-                    video=vid,
-                    caption=caption,
-                    parse_mode='Markdown',
-                    supports_streaming=True
-                )
-                debug_log(f"🟢 Sent video Meme ID: {meme['id']}", show_debug)
+        sha256, media, kind, filename = await load_media(meme, file_ids, transcoder)
+        try:
+            message = await flood.call(chat_id, lambda: send(media, kind, filename))
+        except BadRequest as e:
+            if not isinstance(media, str):
+                raise
+            debug_log(f"  🟠 Stored file_id for Meme ID {meme['id']} was rejected ({e}), uploading again", show_debug)
+            file_ids.forget(sha256)
+            sha256, media, kind, filename = await load_media(meme, file_ids, transcoder, upload=True)
+            message = await flood.call(chat_id, lambda: send(media, kind, filename))
+        file_ids.record(sha256, message)
+        reused = " (by file_id)" if isinstance(media, str) else ""
+        debug_log(f"🟢 Sent {meme['type']} Meme ID: {meme['id']}{reused}", show_debug)
+        return True
     except Exception as e:
         debug_log(f"🔴 Failed to send Meme ID {meme['id']}: {e}", show_debug)
+        return False
+
+async def send_album_async(bot, memes, chat_id, flood, file_ids, transcoder=None, show_debug=True):
+    """Send memes as one media group, falling back to single sends if the group fails; returns the number sent"""
+    if len(memes) > 1:
+        try:
+            loaded = await asyncio.gather(*(load_media(meme, file_ids, transcoder) for meme in memes))
+            media = [input_media(meme, *item[1:]) for meme, item in zip(memes, loaded)]
+            messages = await flood.call(chat_id, lambda: bot.send_media_group(chat_id=chat_id, media=media), cost=len(media))
+            for (sha256, *_), message in zip(loaded, messages):
+                file_ids.record(sha256, message)
+            debug_log(f"🟢 Sent album of {len(memes)} memes: {', '.join(meme['id'] for meme in memes)}", show_debug)
+            return len(memes)
+        except Exception as e:
+            debug_log(f"🟠 Album of {len(memes)} memes failed ({e}), sending them one by one", show_debug)
+    sent = 0
+    for meme in memes:
+        sent += await send_meme_async(bot, meme, chat_id, flood, file_ids, transcoder, show_debug)
+    return sent
+
+async def fan_out_async(bot, memes, chat_ids, flood, file_ids, transcoder=None, show_debug=True):
+    """Upload memes to the first chat, then send them by file_id to the others concurrently; returns the number of sends that succeeded"""
+    sent = await send_album_async(bot, memes, chat_ids[0], flood, file_ids, transcoder, show_debug)
+    if len(chat_ids) > 1:
+        sent += sum(await asyncio.gather(*(
+            send_album_async(bot, memes, chat_id, flood, file_ids, transcoder, show_debug) for chat_id in chat_ids[1:]
+        )))
+    return sent
 
 async def main():
     args = parse_args()
@@ -71,15 +175,41 @@ async def main():
         return
 
     try:
-        with open(args.metadata, 'r') as f:
-            memes = json.load(f)
-        debug_log(f"🟢 Loaded {len(memes)} memes from metadata.", args.debug)
+        request = HTTPXRequest(read_timeout=READ_TIMEOUT, media_write_timeout=UPLOAD_TIMEOUT)
+        flood = FloodControl(args.debug)
+        file_ids = FileIdCache(args.file_ids, args.debug)
+        transcoder = Transcoder(show_debug=args.debug) if args.transcode else None
+        chat_ids = [chat_id.strip() for value in args.chat_id for chat_id in value.split(',') if chat_id.strip()]
+        workers = 1 if args.ordered else max(1, args.workers)
+        slots = asyncio.Semaphore(workers)
+        results = []
+        tasks = set()
+
+        async def send(batch):
+            try:
+                results.append((len(batch), await fan_out_async(bot, batch, chat_ids, flood, file_ids, transcoder, args.debug)))
+            finally:
+                slots.release()
 
-        bot = Bot(token=args.token)
-        for meme in memes:
-            await send_meme_async(bot, meme, args.chat_id, args.debug)
+        async with Bot(token=args.token, request=request) as bot:
+            # Reading happens in a thread, --follow sleeps while waiting for new lines
+            batches = batch_memes(read_metadata(args.metadata, follow=args.follow, show_debug=args.debug), max(1, min(args.album_size, ALBUM_SIZE)))
+            while (batch := await asyncio.to_thread(next, batches, None)) is not None:
+                await slots.acquire()
+                task = asyncio.create_task(send(batch))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            if tasks:
+                await asyncio.gather(*tasks)
+        file_ids.save()
+        if transcoder:
+            transcoder.close()
 
-        debug_log("🟢 All memes have been processed.", args.debug)
+        total = sum(count for count, _ in results)
+        sends = total * len(chat_ids)
+        sent = sum(sent for _, sent in results)
+        chats = f" to {len(chat_ids)} chats" if len(chat_ids) > 1 else ""
+        debug_log(f"🟢 All {total} memes have been processed{chats} ({sent} sent, {sends - sent} failed).", args.debug)
 
     except Exception as e:
         debug_log(f"🔴 Error processing memes: {e}", args.debug)
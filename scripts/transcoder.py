@@ -0,0 +1,134 @@
+import os
+import json
+import shutil
+import asyncio
+import subprocess
+from concurrent.futures import ProcessPoolExecutor
+from PIL import Image
+
+# Constants and Configuration
+TRANSCODE_DIR = "cache/transcoded"
+IMAGE_MAX_SIDE = 2560  # px on the long side; Telegram shows photos smaller anyway
+IMAGE_MAX_BYTES = 5 * 1024 * 1024  # Well under the 10 MB photo limit
+JPEG_QUALITIES = (85, 75, 65)  # Tried in order until the image fits IMAGE_MAX_BYTES
+VIDEO_MAX_BYTES = 48 * 1024 * 1024  # Bot API uploads stop at 50 MB
+VIDEO_MAX_SIDE = 1280
+AUDIO_BITRATE = 128_000
+BITRATE_HEADROOM = 0.9  # Container overhead and rate control overshoot
+FFMPEG_TIMEOUT = 600  # seconds per video
+
+def debug_log(msg, show_debug=True):
+    if show_debug:
+        print(msg)
+
+def ffmpeg(*args):
+    subprocess.run(["ffmpeg", "-y", "-v", "error", *args], check=True, timeout=FFMPEG_TIMEOUT)
+
+def video_duration(src):
+    result = subprocess.run(
+        ["ffprobe", "-v", "error", "-show_entries", "format=duration", "-of", "json", src],
+        check=True, capture_output=True, text=True
+    )
+    return float(json.loads(result.stdout)['format']['duration'])
+
+def encode_image(src, out_base):
+    """Re-encode an image as a JPEG within IMAGE_MAX_SIDE and IMAGE_MAX_BYTES"""
+    out_fname = f"{out_base}.jpg"
+    tmp_fname = f"{out_fname}.tmp"
+    with Image.open(src) as image:
+        image.thumbnail((IMAGE_MAX_SIDE, IMAGE_MAX_SIDE), Image.LANCZOS)
+        if image.mode in ("RGBA", "LA", "P"):
+            image = image.convert("RGBA")
+            background = Image.new("RGB", image.size, (255, 255, 255))  # Flatten transparency onto white
+            background.paste(image, mask=image.getchannel("A"))
+            image = background
+        elif image.mode != "RGB":
+            image = image.convert("RGB")
+        for quality in JPEG_QUALITIES:
+            image.save(tmp_fname, "JPEG", quality=quality, optimize=True, progressive=True)
+            if os.path.getsize(tmp_fname) <= IMAGE_MAX_BYTES:
+                break
+    os.replace(tmp_fname, out_fname)
+    return out_fname
+
+def encode_video(src, out_base, max_bytes=None):
+    """Re-encode a video (or animated GIF) as H.264 MP4, fitting max_bytes if given"""
+    out_fname = f"{out_base}.mp4"
+    tmp_fname = f"{out_base}.tmp.mp4"
+    args = ["-i", src, "-vf", f"scale='min({VIDEO_MAX_SIDE},iw)':-2,format=yuv420p", "-c:v", "libx264", "-preset", "veryfast"]
+    if max_bytes:
+        bitrate = max(int(max_bytes * 8 / video_duration(src) * BITRATE_HEADROOM) - AUDIO_BITRATE, 100_000)
+        args += ["-b:v", str(bitrate), "-maxrate", str(bitrate), "-bufsize", str(bitrate * 2)]
+    ffmpeg(*args, "-c:a", "aac", "-b:a", str(AUDIO_BITRATE), "-movflags", "+faststart", tmp_fname)
+    os.replace(tmp_fname, out_fname)
+    return out_fname
+
+def transcode(src, out_base, kind, use_ffmpeg):
+    """Runs in a worker process; returns (file to send, 'image' or 'video')"""
+    if kind == 'video':
+        if use_ffmpeg and os.path.getsize(src) > VIDEO_MAX_BYTES:
+            return encode_video(src, out_base, VIDEO_MAX_BYTES), 'video'
+        return src, kind
+
+    with Image.open(src) as image:
+        animated = getattr(image, "n_frames", 1) > 1
+        fits = (
+            image.format == "JPEG"
+            and max(image.size) <= IMAGE_MAX_SIDE
+            and os.path.getsize(src) <= IMAGE_MAX_BYTES
+        )
+    if animated:
+        # As a photo only the first frame would be shown, an MP4 keeps the animation
+        return (encode_video(src, out_base), 'video') if use_ffmpeg else (src, kind)
+    if fits:
+        return src, kind
+    return encode_image(src, out_base), 'image'
+
+class Transcoder:
+    """Optional pre-send stage that shrinks media for Telegram in a process pool.
+
+    Large or non-JPEG images become capped JPEGs, animated GIFs become MP4s
+    and videos over the upload limit are re-encoded to fit it with ffmpeg.
+    Outputs are cached under <root> by the source's SHA-256, so the same
+    file is only converted once, and each hash is converted by one worker
+    even when several sends ask for it at once.
+    """
+
+    def __init__(self, root=TRANSCODE_DIR, workers=None, show_debug=True):
+        self.root = root
+        self.show_debug = show_debug
+        self.use_ffmpeg = bool(shutil.which("ffmpeg") and shutil.which("ffprobe"))
+        if not self.use_ffmpeg:
+            debug_log("🟠 ffmpeg not found, videos and GIFs will be sent as they are", show_debug)
+        self.pool = ProcessPoolExecutor(max_workers=workers or os.cpu_count())
+        self.jobs = {}
+        os.makedirs(root, exist_ok=True)
+
+    def cached(self, sha256):
+        for ext, kind in ((".jpg", 'image'), (".mp4", 'video')):
+            out_fname = os.path.join(self.root, f"{sha256}{ext}")
+            if os.path.exists(out_fname):
+                return out_fname, kind
+        return None
+
+    async def prepare(self, file_path, sha256, kind):
+        """(file to send, kind) for a meme, converting it in the pool if needed"""
+        found = self.cached(sha256)
+        if found:
+            return found
+        if sha256 not in self.jobs:
+            loop = asyncio.get_running_loop()
+            out_base = os.path.join(self.root, sha256)
+            self.jobs[sha256] = loop.run_in_executor(self.pool, transcode, file_path, out_base, kind, self.use_ffmpeg)
+        try:
+            out_fname, out_kind = await self.jobs[sha256]
+        except Exception as e:
+            debug_log(f"  🟠 Could not transcode {os.path.basename(file_path)}, sending it as it is: {e}", self.show_debug)
+            return file_path, kind
+        if out_fname != file_path:
+            before, after = os.path.getsize(file_path), os.path.getsize(out_fname)
+            debug_log(f"  🔵 Transcoded {os.path.basename(file_path)}: {before / 1048576:.1f} MB -> {after / 1048576:.1f} MB", self.show_debug)
+        return out_fname, out_kind
+
+    def close(self):
+        self.pool.shutdown()